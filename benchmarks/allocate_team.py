@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Sign up users from several processes at once and check team balance.
+
+Usage: python benchmarks/allocate_team.py [db url] [processes] [users each]
+
+Defaults to a throwaway SQLite file. Point it at a local MySQL database to
+exercise the row locks taken by allocate_team.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from flask import Flask  # noqa
+from sqlalchemy.exc import OperationalError  # noqa
+
+import utils  # noqa
+from models import db, Team, User  # noqa
+
+
+def create_app(db_url):
+    app = Flask(__name__)
+    app.config.update(
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SQLALCHEMY_DATABASE_URI=db_url
+    )
+    db.init_app(app)
+    return app
+
+
+def sign_up(db_url, worker, users):
+    app = create_app(db_url)
+    with app.app_context():
+        for i in range(users):
+            profile = {
+                "email": "user-{0}-{1}@example.com".format(worker, i),
+                "name": "User {0}-{1}".format(worker, i)
+            }
+            while True:
+                try:
+                    utils.add_user({}, {"access_token": ""}, profile)
+                    break
+                except OperationalError:
+                    # SQLite reports lock contention instead of waiting
+                    db.session.rollback()
+                    time.sleep(0.01)
+
+
+def main(db_url, processes, users):
+    app = create_app(db_url)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        utils.populate_teams_table([
+            ("Team {0}".format(i), "http://example.com/{0}.png".format(i))
+            for i in range(24)
+        ])
+
+    start = time.time()
+    workers = [
+        multiprocessing.Process(target=sign_up, args=(db_url, i, users))
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+
+    with app.app_context():
+        counters = [team.allocation_count for team in Team.query]
+        allocated = [len(team.allocated_users) for team in Team.query]
+        print("Signed up {0} users from {1} processes in {2:.2f}s".format(
+            User.query.count(), processes, elapsed
+        ))
+        print("Users per team: min {0}, max {1}".format(
+            min(allocated), max(allocated)
+        ))
+        assert counters == allocated, "Counters out of sync with users"
+        assert max(allocated) - min(allocated) <= 1, "Allocation unbalanced"
+        print("OK")
+
+
+if __name__ == "__main__":
+    default_url = "sqlite:///{0}".format(
+        os.path.join(tempfile.gettempdir(), "euro2016-allocate-team.db")
+    )
+    main(
+        sys.argv[1] if len(sys.argv) > 1 else default_url,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 8,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 25
+    )
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Check that gunicorn starts with the deployed config on a fresh host and
+that /metrics adds up the requests of every worker.
+
+Usage: python benchmarks/gunicorn_startup.py [--workers N] [--requests N]
+
+Runs gunicorn with src/config/gunicorn.py against a temporary SQLite
+database, overriding only what needs root or a real host: the user, the
+bind address, daemon mode and the log files. The metrics directory is one
+that doesn't exist yet, as on a new instance. Exits with status 1 if the
+server doesn't come up or /metrics doesn't count every request.
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from startup import CONFIG  # noqa
+from slow_upstream import get_free_port, wait_for  # noqa
+
+GUNICORN_CONFIG = os.path.join(ROOT, "src", "config", "gunicorn.py")
+OVERRIDES = """
+exec(open({config!r}).read())
+user = {uid}
+group = {gid}
+bind = "127.0.0.1:{port}"
+workers = {workers}
+daemon = False
+accesslog = None
+errorlog = {errorlog!r}
+"""
+
+
+def count_requests(metrics, route):
+    prefix = 'euro2016_request_latency_seconds_count{'
+    return sum(
+        float(line.split()[-1]) for line in metrics.splitlines()
+        if line.startswith(prefix) and 'route="{0}"'.format(route) in line
+    )
+
+
+def run(options, workdir):
+    os.makedirs(os.path.join(workdir, "config"))
+    with open(os.path.join(workdir, "config", "config.cfg"), "w") as f:
+        f.write(CONFIG.format(os.path.join(workdir, "gunicorn.db")))
+    port = get_free_port()
+    errorlog = os.path.join(workdir, "error.log")
+    config_path = os.path.join(workdir, "gunicorn_config.py")
+    with open(config_path, "w") as f:
+        f.write(OVERRIDES.format(
+            config=GUNICORN_CONFIG, uid=os.getuid(), gid=os.getgid(),
+            port=port, workers=options.workers, errorlog=errorlog
+        ))
+
+    environment = dict(os.environ)
+    environment["EURO2016_METRICS_DIR"] = os.path.join(workdir, "metrics")
+    server = subprocess.Popen([
+        sys.executable, "-c", "from gunicorn.app.wsgiapp import run; run()",
+        "--config", config_path,
+        "--chdir", workdir,
+        "--pythonpath", os.path.join(ROOT, "src"),
+        "wsgi:app"
+    ], cwd=workdir, env=environment)
+    url = "http://127.0.0.1:{0}/".format(port)
+    try:
+        try:
+            wait_for(url + "status")
+        except Exception as e:
+            with open(errorlog) as f:
+                sys.stdout.write(f.read())
+            print("FAIL: {0}".format(e))
+            return False
+        for _ in range(options.requests):
+            requests.get(url + "status").raise_for_status()
+        counted = count_requests(requests.get(url + "metrics").text, "/status")
+    finally:
+        server.terminate()
+        server.wait()
+
+    print("{0} workers, {1} requests to /status, {2:.0f} in /metrics".format(
+        options.workers, options.requests, counted
+    ))
+    # wait_for may have made a few requests of its own
+    ok = counted >= options.requests
+    print("OK" if ok else "FAIL: /metrics is missing requests")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=30)
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="euro2016-gunicorn-")
+    try:
+        ok = run(options, workdir)
+    finally:
+        shutil.rmtree(workdir)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
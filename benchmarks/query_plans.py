@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""Check that the hot queries of the app and the update lambda use the
+indexes declared in models.py.
+
+Usage: python benchmarks/query_plans.py [--db-url URL]
+
+By default the queries are explained against a small synthetic tournament
+in SQLite (see benchmarks/suite.py), without ANALYZE as its statistics
+wouldn't look like a real tournament's. --db-url explains them against an
+existing SQLite or MySQL database instead, e.g. a copy of production after
+running create_db_tables.py. Exits with status 1 if any query doesn't use
+its index or has to sort its rows.
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from flask import Flask  # noqa
+from sqlalchemy import desc  # noqa
+from sqlalchemy.sql import ClauseElement  # noqa
+
+from models import db, User, Prediction, Fixture  # noqa
+from suite import create_tournament  # noqa
+
+
+# Name, query, table, expected index (None for any) and whether the index
+# must also provide the order of the rows
+HOT_QUERIES = [
+    ("is_user_logged_in", lambda: User.query.filter_by(
+        email="user-1@example.com"
+    ), "users", None, False),
+    ("set_predictions", lambda: db.session.query(
+        Prediction.id, Prediction.fixture_id, Prediction.home_score,
+        Prediction.away_score
+    ).filter_by(
+        user_id=1
+    ), "predictions", "uq_predictions_user_fixture", False),
+    ("prediction for a fixture", lambda: Prediction.query.filter_by(
+        user_id=1, fixture_id=1
+    ), "predictions", "uq_predictions_user_fixture", False),
+    ("leaderboard", lambda: db.session.query(
+        User.id, User.name, User.points
+    ).order_by(
+        desc(User.points), User.name
+    ), "users", "ix_users_points_name", True),
+    ("users who predicted games", lambda: db.session.query(
+        Prediction.user_id
+    ).filter(
+        Prediction.fixture_id.in_([1, 2])
+    ).distinct(), "predictions", "ix_predictions_fixture", False),
+    ("rescore chunk", lambda: db.session.query(
+        Prediction.id, Prediction.user_id, Prediction.points
+    ).filter(
+        Prediction.user_id.in_([1, 2, 3])
+    ), "predictions", "uq_predictions_user_fixture", False),
+    ("predictions export", lambda: db.session.query(
+        User.id, User.name, Fixture.matchday, Fixture.home_team,
+        Prediction.home_score, Fixture.away_team, Prediction.away_score,
+        Prediction.points
+    ).join(Prediction.user).join(Prediction.fixture).order_by(
+        Prediction.user_id, Prediction.fixture_id
+    ), "predictions", "uq_predictions_user_fixture", True)
+]
+
+
+def compile_query(query):
+    statement = query if isinstance(query, ClauseElement) else \
+        query.statement
+    return str(statement.compile(
+        dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}
+    ))
+
+
+def explain_sqlite(sql, table):
+    details = [
+        row[-1] for row in db.session.execute("EXPLAIN QUERY PLAN " + sql)
+    ]
+    indexes = set()
+    for detail in details:
+        words = detail.split()
+        if table in words and "INDEX" in words:
+            indexes.add(words[words.index("INDEX") + 1])
+    sorts = any("TEMP B-TREE FOR ORDER BY" in detail for detail in details)
+    return indexes, sorts, "; ".join(details)
+
+
+def explain_mysql(sql, table):
+    rows = [dict(row) for row in db.session.execute("EXPLAIN " + sql)]
+    indexes = {row["key"] for row in rows if row["table"] == table}
+    indexes.discard(None)
+    sorts = any("filesort" in (row["Extra"] or "") for row in rows)
+    return indexes, sorts, "; ".join(
+        "{0}: {1} {2}".format(row["table"], row["key"], row["Extra"])
+        for row in rows
+    )
+
+
+def check_query_plans():
+    explain = explain_mysql if db.engine.dialect.name == "mysql" else \
+        explain_sqlite
+    failures = 0
+    for name, get_query, table, index, ordered in HOT_QUERIES:
+        indexes, sorts, plan = explain(compile_query(get_query()), table)
+        ok = bool(indexes) if index is None else index in indexes
+        ok = ok and not (ordered and sorts)
+        failures += not ok
+        print("{0:<28} {1:<5} {2}".format(name, "ok" if ok else "FAIL", plan))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db-url")
+    options = parser.parse_args()
+
+    workdir = None
+    db_url = options.db_url
+    if db_url is None:
+        workdir = tempfile.mkdtemp(prefix="euro2016-query-plans-")
+        db_path = os.path.join(workdir, "query-plans.db")
+        create_tournament(db_path, 200, 24, 24)
+        db_url = "sqlite:///{0}".format(db_path)
+
+    app = Flask(__name__)
+    app.config.update(
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SQLALCHEMY_DATABASE_URI=db_url
+    )
+    db.init_app(app)
+    try:
+        with app.app_context():
+            failures = check_query_plans()
+    finally:
+        if workdir:
+            shutil.rmtree(workdir)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
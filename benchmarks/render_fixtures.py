@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Time rendering the fixture rows of my-predictions.html from raw
+football-data fixtures (parsing dates per row) against pre-parsed
+FixtureRecords.
+
+Usage: python benchmarks/render_fixtures.py [number of fixtures]
+"""
+
+import os
+import sys
+import timeit
+
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from dateutil.parser import parse as parse_date  # noqa
+from dateutil.tz import tzutc  # noqa
+from jinja2 import Environment  # noqa
+
+from football_data_client import FixtureIndex  # noqa
+
+# The per row logic of my-predictions.html before fixtures were pre-parsed
+RAW_TEMPLATE = """
+{% for fixture in fixtures %}
+    {% set game = fixture.matchday|string + '_' + fixture.homeTeamName + '_' + fixture.awayTeamName %}
+    {% set kick_off = fixture.date|convert_to_datetime %}
+    {% set editable = True if current_time < kick_off else False %}
+    <p>{{ fixture.date|strftime }}</p>
+    <label>{{ fixture.homeTeamName }}</label>
+    <p>{{ predictions.get(game).home_score }}</p>
+    <label>{{ fixture.awayTeamName }}</label>
+    <p>{{ predictions.get(game).away_score }}</p>
+{% endfor %}
+"""  # noqa
+
+RECORD_TEMPLATE = """
+{% for fixture in fixtures %}
+    {% set editable = True if fixture.key in open_fixtures else False %}
+    <p>{{ fixture.kick_off_display }}</p>
+    <label>{{ fixture.home_team }}</label>
+    <p>{{ predictions.get(fixture.id).home_score }}</p>
+    <label>{{ fixture.away_team }}</label>
+    <p>{{ predictions.get(fixture.id).away_score }}</p>
+{% endfor %}
+"""
+
+
+def main(size):
+    start = datetime(2016, 6, 10, 19, tzinfo=tzutc())
+    fixtures = [
+        {
+            "matchday": i // 12 + 1,
+            "homeTeamName": "Home {0}".format(i),
+            "awayTeamName": "Away {0}".format(i),
+            "date": (start + timedelta(hours=3 * i)).strftime(
+                "%Y-%m-%dT%H:%M:%SZ"
+            ),
+            "status": "TIMED"
+        }
+        for i in range(size)
+    ]
+    predictions = {
+        "{0}_Home {1}_Away {1}".format(i // 12 + 1, i): {
+            "home_score": 1, "away_score": 0
+        }
+        for i in range(size)
+    }
+    record_predictions = {
+        i + 1: {"home_score": 1, "away_score": 0} for i in range(size)
+    }
+    current_time = start + timedelta(days=5)
+
+    env = Environment()
+    env.filters["convert_to_datetime"] = parse_date
+    env.filters["strftime"] = lambda date_time: parse_date(
+        date_time
+    ).strftime("%a %d %B %Y - %H:%M UTC")
+    raw_template = env.from_string(RAW_TEMPLATE)
+    record_template = env.from_string(RECORD_TEMPLATE)
+    fixture_index = FixtureIndex(fixtures)
+    fixture_index.set_ids({
+        fixture.key: i + 1 for i, fixture in enumerate(fixture_index.fixtures)
+    })
+    open_fixtures = fixture_index.get_open_fixtures(current_time)
+
+    timings = [
+        ("raw fixtures", lambda: raw_template.render(
+            fixtures=fixtures, predictions=predictions,
+            current_time=current_time
+        )),
+        ("fixture records", lambda: record_template.render(
+            fixtures=fixture_index.fixtures, predictions=record_predictions,
+            open_fixtures=open_fixtures
+        )),
+        ("index build", lambda: FixtureIndex(fixtures))
+    ]
+
+    print("Rendering {0} fixtures (best of 20)".format(size))
+    for name, func in timings:
+        best = min(timeit.repeat(func, number=1, repeat=20))
+        print("{0:>16}: {1:8.2f} ms".format(name, best * 1000))
+    print("The index is built once per fixtures snapshot, not per render.")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 51)
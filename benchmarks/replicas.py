@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Check that reads go to the read replica and that a user who just wrote
+reads their own write from the primary.
+
+Usage: python benchmarks/replicas.py
+
+Copies a small SQLite tournament to a second file used as the replica, then
+changes a user's name on the primary only, as if the replica lagged
+behind. A logged in user must see the replica's leaderboard, see the
+primary's leaderboard and their new predictions right after submitting
+them, and go back to the replica once PRIMARY_UNTIL_KEY has expired.
+Exits with status 1 if any page reads from the wrong database.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import app  # noqa
+import utils  # noqa
+from models import db, User, PRIMARY_UNTIL_KEY  # noqa
+from startup import CONFIG  # noqa
+from suite import create_tournament, get_games, reset_caches  # noqa
+
+REPLICA_CONFIG = """replica_db_urls = sqlite:///{0}
+read_your_writes_seconds = 30
+"""
+FIXTURES = 4
+PRIMARY_ONLY_NAME = "Written To The Primary"
+PREDICTION = 'id="home_score_1" value="7"'
+
+
+def get_fixtures():
+    return [
+        {
+            "matchday": matchday,
+            "homeTeamName": home_team,
+            "awayTeamName": away_team,
+            "date": "2030-06-{0:02d}T19:00:00Z".format(10 + i),
+            "status": "TIMED",
+            "result": {"goalsHomeTeam": None, "goalsAwayTeam": None}
+        }
+        for i, (matchday, home_team, away_team) in enumerate(
+            get_games(FIXTURES)
+        )
+    ]
+
+
+def read_pages(client):
+    # Which database each page was read from, judging by the rows that
+    # only the primary has
+    reset_caches()
+    leaderboard = client.get("/predictions")
+    assert leaderboard.status_code == 200, leaderboard.data
+    predictions = client.get("/my-predictions")
+    assert predictions.status_code == 200, predictions.data
+    return (
+        PRIMARY_ONLY_NAME in leaderboard.data.decode("utf-8"),
+        PREDICTION in predictions.data.decode("utf-8")
+    )
+
+
+def run(workdir):
+    primary_path = os.path.join(workdir, "primary.db")
+    replica_path = os.path.join(workdir, "replica.db")
+    create_tournament(primary_path, 10, FIXTURES, 0)
+    shutil.copy(primary_path, replica_path)
+
+    config_path = os.path.join(workdir, "config.cfg")
+    with open(config_path, "w") as f:
+        f.write(CONFIG.format(primary_path))
+        f.write(REPLICA_CONFIG.format(replica_path))
+    flask_app = app.create_app(config_path)
+    with flask_app.app_context():
+        app.football_api_client.get_all_fixtures = get_fixtures
+        User.query.filter_by(email="user-1@example.com").update(
+            {User.name: PRIMARY_ONLY_NAME}
+        )
+        db.session.commit()
+
+        client = flask_app.test_client()
+        with client.session_transaction() as session:
+            session["access_token"] = "benchmark"
+            session["user"] = {"email": "user-0@example.com"}
+        results = [("before submitting", read_pages(client), (False, False))]
+
+        response = client.post("/submit", data={
+            "fixture_id": "1", "home_score_1": "7", "away_score_1": "0"
+        })
+        assert response.status_code == 302, response.data
+        with client.session_transaction() as session:
+            pinned = PRIMARY_UNTIL_KEY in session
+        results.append(("after submitting", read_pages(client), (True, True)))
+
+        with client.session_transaction() as session:
+            session.pop(PRIMARY_UNTIL_KEY, None)
+        results.append(("pin expired", read_pages(client), (False, False)))
+
+    print("{0:<20} {1}".format("pinned by /submit", pinned))
+    for name, (leaderboard, predictions), _ in results:
+        print("{0:<20} leaderboard from {1}, predictions from {2}".format(
+            name, "primary" if leaderboard else "replica",
+            "primary" if predictions else "replica"
+        ))
+    return pinned and all(
+        reads == expected for _, reads, expected in results
+    )
+
+
+def main():
+    utils.google_oauth2_client.is_access_token_valid = lambda token: True
+    workdir = tempfile.mkdtemp(prefix="euro2016-replicas-")
+    try:
+        ok = run(workdir)
+    finally:
+        shutil.rmtree(workdir)
+    print("OK" if ok else "FAIL: a page read from the wrong database")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Compare the batch scoring kernel against the old per-prediction loop.
+
+Usage: python benchmarks/scoring.py [number of predictions]
+"""
+
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import scoring  # noqa
+
+
+def score_predictions_loop(predictions, results):
+    # The dict based if/elif chain scoring used before the batch kernel
+    points = []
+    for predicted_score, result in zip(predictions, results):
+        if (
+            predicted_score["home_score"] == result["home_score"] and
+            predicted_score["away_score"] == result["away_score"]
+        ):
+            points.append(3)
+        elif (
+            predicted_score["home_score"] == predicted_score["away_score"] and
+            result["home_score"] == result["away_score"]
+        ):
+            points.append(1)
+        elif (
+            predicted_score["home_score"] > predicted_score["away_score"] and
+            result["home_score"] > result["away_score"]
+        ):
+            points.append(1)
+        elif (
+            predicted_score["home_score"] < predicted_score["away_score"] and
+            result["home_score"] < result["away_score"]
+        ):
+            points.append(1)
+        else:
+            points.append(0)
+    return points
+
+
+def main(size):
+    goals = [[random.randint(0, 4) for _ in range(size)] for _ in range(4)]
+    predictions = [
+        {"home_score": home, "away_score": away}
+        for home, away in zip(goals[0], goals[1])
+    ]
+    results = [
+        {"home_score": home, "away_score": away}
+        for home, away in zip(goals[2], goals[3])
+    ]
+
+    expected = score_predictions_loop(predictions, results)
+    assert scoring.score_predictions_python(*goals) == expected
+    timings = [
+        ("loop", lambda: score_predictions_loop(predictions, results)),
+        ("python", lambda: scoring.score_predictions_python(*goals)),
+        ("score_predictions", lambda: scoring.score_predictions(*goals))
+    ]
+    numpy = scoring.get_numpy()
+    if numpy is not None:
+        assert list(scoring.score_predictions_numpy(*goals)) == expected
+        arrays = [numpy.asarray(g, dtype="int32") for g in goals]
+        timings += [
+            ("numpy", lambda: scoring.score_predictions_numpy(*goals)),
+            ("numpy (arrays)",
+             lambda: scoring.score_predictions_numpy(*arrays))
+        ]
+
+    print("Scoring {0} predictions (best of 5)".format(size))
+    baseline = None
+    for name, func in timings:
+        best = min(timeit.repeat(func, number=1, repeat=5))
+        baseline = baseline or best
+        print("{0:>17}: {1:8.2f} ms ({2:.1f}x)".format(
+            name, best * 1000, baseline / best
+        ))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""Load test gunicorn sync and gevent workers against a slow upstream.
+
+Starts a local stand-in for Google's tokeninfo endpoint that takes
+--delay seconds to answer, then serves a WSGI app that validates a fresh
+access token on every request (so the token cache never helps) under each
+worker class in turn, and reports how many requests per second it could
+complete with --concurrency clients.
+
+Usage: python benchmarks/slow_upstream.py [--workers N] [--delay S]
+                                          [--concurrency N] [--requests N]
+"""
+
+import os
+import sys
+import time
+import uuid
+import socket
+import argparse
+import threading
+import subprocess
+
+from multiprocessing.pool import ThreadPool
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from google_oauth_client import GoogleOauth2Client, TokenValidationCache  # noqa
+
+
+def app(environ, start_response):
+    """WSGI app run by the gunicorn workers under test."""
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    if "HTTP_X_UPSTREAM" not in environ:
+        # Readiness check
+        return ["OK"]
+    client = GoogleOauth2Client(
+        base_endpoint=environ["HTTP_X_UPSTREAM"], cache=TokenValidationCache()
+    )
+    return [str(client.is_access_token_valid(uuid.uuid4().hex))]
+
+
+class SlowTokenInfoHandler(BaseHTTPRequestHandler):
+    delay = 1.0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = '{"expires_in": "3600"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise Exception("{0} didn't come up".format(url))
+
+
+def run_load(worker_class, options, upstream):
+    port = get_free_port()
+    url = "http://127.0.0.1:{0}/".format(port)
+    server = subprocess.Popen([
+        sys.executable, "-c", "from gunicorn.app.wsgiapp import run; run()",
+        "--chdir", os.path.dirname(os.path.abspath(__file__)),
+        "--pythonpath", os.path.join(ROOT, "src"),
+        "--bind", "127.0.0.1:{0}".format(port),
+        "--workers", str(options.workers),
+        "--worker-class", worker_class,
+        "--timeout", "120",
+        "--log-level", "warning",
+        "slow_upstream:app"
+    ])
+    try:
+        wait_for(url)
+        session = requests.Session()
+
+        def call(_):
+            return session.get(
+                url, headers={"X-Upstream": upstream}, timeout=120
+            ).status_code
+
+        pool = ThreadPool(options.concurrency)
+        start = time.time()
+        statuses = pool.map(call, range(options.requests))
+        elapsed = time.time() - start
+        pool.close()
+        print("{0:>7}: {1} requests in {2:.2f}s, {3:.1f} req/s, {4} ok".format(
+            worker_class, options.requests, elapsed,
+            options.requests / elapsed, statuses.count(200)
+        ))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--delay", type=float, default=0.5)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200)
+    options = parser.parse_args()
+
+    SlowTokenInfoHandler.delay = options.delay
+    upstream = ThreadingHTTPServer(("127.0.0.1", 0), SlowTokenInfoHandler)
+    thread = threading.Thread(target=upstream.serve_forever)
+    thread.daemon = True
+    thread.start()
+    upstream_url = "http://127.0.0.1:{0}".format(upstream.server_address[1])
+
+    print("{0} workers, {1}s upstream delay, {2} concurrent clients".format(
+        options.workers, options.delay, options.concurrency
+    ))
+    for worker_class in ["sync", "gevent"]:
+        run_load(worker_class, options, upstream_url)
+    upstream.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""Hold thousands of idle /updates subscribers on one gevent worker.
+
+Starts gunicorn with a single gevent worker against a synthetic tournament
+in SQLite (see benchmarks/suite.py), opens --subscribers event streams and
+leaves them idle for --idle seconds. It then records a new result and its
+points the way the update lambda does, and times how long each subscriber
+takes to receive the results event. Reports the worker's memory per
+subscriber and the database connections it holds open while they wait,
+which stay flat as subscribers don't keep one. Linux only, as it reads the
+worker's memory and open files from /proc.
+
+Usage: python benchmarks/sse_subscribers.py [--subscribers N] [--users N]
+                                            [--idle S] [--timeout S]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import gevent
+import requests
+
+from gevent import socket
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(1, os.path.join(ROOT, "lambda"))
+
+import utils  # noqa
+import update_points  # noqa
+from suite import create_tournament  # noqa
+from slow_upstream import get_free_port, wait_for  # noqa
+
+CONFIG_ENVIRONMENT_VARIABLE = "EURO2016_BENCHMARK_CONFIG"
+CONFIG = """
+[flask]
+secret_key = benchmark
+
+[football_data]
+api_key = benchmark
+
+[google_login]
+whitelisted_domains = _all_
+client_id = benchmark
+client_secret = benchmark
+redirect_scheme = http
+
+[db]
+sqlalchemy_db_url = sqlite:///{0}
+"""
+FIXTURES = 51
+
+
+def create_benchmark_app():
+    """WSGI app run by the gunicorn worker, accepting any access token."""
+    import app
+    utils.google_oauth2_client.is_access_token_valid = lambda token: True
+    return app.create_app(os.environ[CONFIG_ENVIRONMENT_VARIABLE])
+
+
+def get_session_cookie(config_path):
+    import app
+    flask_app = app.create_app(config_path)
+    return flask_app.session_interface.get_signing_serializer(
+        flask_app
+    ).dumps({
+        "access_token": "benchmark",
+        "user": {"email": "user-0@example.com", "name": "User 0"}
+    })
+
+
+def get_worker_pid(master_pid):
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/{0}/stat".format(pid)) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # The parent pid follows the state, after the parenthesised name
+        if int(stat.rsplit(")", 1)[1].split()[1]) == master_pid:
+            return int(pid)
+    raise Exception("gunicorn has no worker")
+
+
+def get_rss_kb(pid):
+    with open("/proc/{0}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+
+def count_open_files(pid, path):
+    fd_dir = "/proc/{0}/fd".format(pid)
+    count = 0
+    for fd in os.listdir(fd_dir):
+        try:
+            if os.readlink(os.path.join(fd_dir, fd)) == path:
+                count += 1
+        except OSError:
+            pass
+    return count
+
+
+def get_subscriber_gauge(url):
+    for line in requests.get(url + "metrics").text.splitlines():
+        if line.startswith("euro2016_live_update_subscribers "):
+            return int(float(line.split()[1]))
+
+
+def subscribe(address, cookie, connected, received):
+    """Open an event stream and record when the state and the first
+    results event arrive.
+    """
+    sock = socket.create_connection(address)
+    try:
+        sock.sendall(
+            "GET /updates HTTP/1.0\r\nHost: localhost\r\n"
+            "Cookie: session={0}\r\n\r\n".format(cookie)
+        )
+        buffer = ""
+        for name, times in [("state", connected), ("results", received)]:
+            marker = "event: {0}\n".format(name)
+            while marker not in buffer:
+                data = sock.recv(65536)
+                if not data:
+                    raise Exception("Stream closed before " + name)
+                buffer += data
+            times.append(time.time())
+            buffer = buffer[buffer.index(marker) + len(marker):]
+    finally:
+        sock.close()
+
+
+def publish_result(db_path, fixture_id):
+    """Record a new result and score it, as the update lambda does.
+    Returns when the result was committed.
+    """
+    Session = update_points.get_session_factory(
+        "sqlite:///{0}".format(db_path)
+    )
+    session = Session()
+    try:
+        update_points.update_results(
+            session, {fixture_id: {"home_score": 1, "away_score": 0}}
+        )
+    finally:
+        session.close()
+    committed_at = time.time()
+    update_points.score_results(Session, workers=1)
+    return committed_at
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(options, workdir):
+    db_path = os.path.join(workdir, "sse.db")
+    config_path = os.path.join(workdir, "config.cfg")
+    with open(config_path, "w") as f:
+        f.write(CONFIG.format(db_path))
+    create_tournament(db_path, options.users, FIXTURES, FIXTURES)
+    cookie = get_session_cookie(config_path)
+
+    port = get_free_port()
+    url = "http://127.0.0.1:{0}/".format(port)
+    environment = dict(os.environ)
+    environment[CONFIG_ENVIRONMENT_VARIABLE] = config_path
+    server = subprocess.Popen([
+        sys.executable, "-c", "from gunicorn.app.wsgiapp import run; run()",
+        "--chdir", os.path.dirname(os.path.abspath(__file__)),
+        "--pythonpath", os.path.join(ROOT, "src"),
+        "--bind", "127.0.0.1:{0}".format(port),
+        "--workers", "1",
+        "--worker-class", "gevent",
+        "--worker-connections", str(options.subscribers + 100),
+        "--backlog", str(options.subscribers + 100),
+        "--timeout", "120",
+        "--log-level", "warning",
+        "sse_subscribers:create_benchmark_app()"
+    ], cwd=workdir, env=environment)
+    greenlets = []
+    try:
+        wait_for(url + "status")
+        worker_pid = get_worker_pid(server.pid)
+        rss_before = get_rss_kb(worker_pid)
+
+        connected = []
+        received = []
+        start = time.time()
+        greenlets = [
+            gevent.spawn(
+                subscribe, ("127.0.0.1", port), cookie, connected, received
+            )
+            for _ in range(options.subscribers)
+        ]
+        while len(connected) < options.subscribers:
+            failed = [greenlet for greenlet in greenlets if greenlet.dead]
+            if failed:
+                raise failed[0].exception or Exception("Subscriber failed")
+            if time.time() - start > options.timeout:
+                raise Exception("Only {0} subscribers connected".format(
+                    len(connected)
+                ))
+            gevent.sleep(0.1)
+        connect_time = max(connected) - start
+
+        gevent.sleep(options.idle)
+        rss_after = get_rss_kb(worker_pid)
+        db_connections = count_open_files(worker_pid, db_path)
+        gauge = get_subscriber_gauge(url)
+
+        published_at = publish_result(db_path, FIXTURES)
+        gevent.joinall(greenlets, timeout=options.timeout)
+        latencies = [at - published_at for at in received]
+    finally:
+        gevent.killall(greenlets)
+        server.terminate()
+        server.wait()
+
+    print("{0} subscribers on one gevent worker, {1} users".format(
+        options.subscribers, options.users
+    ))
+    print("connected in {0:.2f}s, then idle for {1}s".format(
+        connect_time, options.idle
+    ))
+    print("worker rss: {0:.1f} MB before, {1:.1f} MB with subscribers "
+          "({2:.1f} KB per subscriber)".format(
+              rss_before / 1024.0, rss_after / 1024.0,
+              float(rss_after - rss_before) / options.subscribers
+          ))
+    print("open database connections: {0}".format(db_connections))
+    print("subscribers reported by /metrics: {0}".format(gauge))
+    if latencies:
+        print("results event received by {0}/{1}: first {2:.2f}s, median "
+              "{3:.2f}s, p99 {4:.2f}s, last {5:.2f}s after the commit".format(
+                  len(latencies), options.subscribers, min(latencies),
+                  percentile(latencies, 0.5), percentile(latencies, 0.99),
+                  max(latencies)
+              ))
+    else:
+        print("results event received by 0/{0}".format(options.subscribers))
+    return len(latencies) == options.subscribers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--idle", type=float, default=5)
+    parser.add_argument("--timeout", type=float, default=60)
+    options = parser.parse_args()
+
+    # Both ends of every stream are open in this process and the worker
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = options.subscribers + 1024
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+    workdir = tempfile.mkdtemp(prefix="euro2016-sse-")
+    try:
+        ok = run(options, workdir)
+    finally:
+        shutil.rmtree(workdir)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
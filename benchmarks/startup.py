@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""Measure how long the app and the scripts take to start.
+
+Usage:
+    python benchmarks/startup.py [--repeat N] [--save NAME] [--compare NAME]
+
+Every measurement runs in a fresh interpreter against a temporary SQLite
+database and reports the median of --repeat runs:
+
+- import app: importing the web app module
+- create_app: building the app from its config
+- first response: interpreter start to the first "/" response, which
+  imports, creates the app, connects to the database and renders
+- forked first response: the same request in a worker forked from a
+  process that already created the app, as with gunicorn's preload_app
+- import create_db_tables: the table creation script's imports
+
+--save and --compare work as in benchmarks/suite.py, with the figures kept
+in benchmarks/baselines/startup-NAME.json.
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SRC = os.path.join(ROOT, "src")
+BASELINES_DIR = os.path.join(ROOT, "benchmarks", "baselines")
+
+CONFIG = """
+[flask]
+secret_key = benchmark
+
+[football_data]
+api_key = benchmark
+
+[google_login]
+whitelisted_domains = _all_
+client_id = benchmark
+client_secret = benchmark
+redirect_scheme = http
+
+[db]
+sqlalchemy_db_url = sqlite:///{0}
+"""
+
+# Each child prints the elapsed milliseconds as its last line
+SCENARIOS = [
+    ("import app", """
+start = time.time()
+import app
+report(start)
+"""),
+    ("create_app", """
+import app
+start = time.time()
+app.create_app(CONFIG_PATH)
+report(start)
+"""),
+    ("first response", """
+start = START
+import app
+client = app.create_app(CONFIG_PATH).test_client()
+assert client.get("/").status_code == 200
+report(start)
+"""),
+    ("forked first response", """
+import app
+client = app.create_app(CONFIG_PATH).test_client()
+start = time.time()
+pid = os.fork()
+if pid == 0:
+    assert client.get("/").status_code == 200
+    report(start)
+    os._exit(0)
+os.waitpid(pid, 0)
+"""),
+    ("import create_db_tables", """
+start = time.time()
+import create_db_tables
+report(start)
+""")
+]
+
+PRELUDE = """
+import time
+START = time.time()
+import os
+import sys
+sys.path.insert(0, {src!r})
+CONFIG_PATH = {config_path!r}
+
+
+def report(start):
+    sys.stdout.write("{{0}}\\n".format((time.time() - start) * 1000))
+    sys.stdout.flush()
+"""
+
+
+def create_database(workdir, config_path):
+    code = PRELUDE.format(src=SRC, config_path=config_path) + """
+import app
+from models import db
+with app.create_app(CONFIG_PATH).app_context():
+    db.create_all()
+"""
+    subprocess.check_call([sys.executable, "-c", code], cwd=workdir)
+
+
+def run_scenario(code, workdir, config_path):
+    output = subprocess.check_output(
+        [sys.executable, "-c",
+         PRELUDE.format(src=SRC, config_path=config_path) + code],
+        cwd=workdir
+    )
+    return float(output.strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def run_suite(options):
+    workdir = tempfile.mkdtemp(prefix="euro2016-startup-")
+    config_path = os.path.join(workdir, "config.cfg")
+    with open(config_path, "w") as f:
+        f.write(CONFIG.format(os.path.join(workdir, "startup.db")))
+    try:
+        create_database(workdir, config_path)
+        figures = {}
+        for name, code in SCENARIOS:
+            figures[name] = median([
+                run_scenario(code, workdir, config_path)
+                for _ in range(options.repeat)
+            ])
+        return figures
+    finally:
+        shutil.rmtree(workdir)
+
+
+def print_figures(figures, baseline=None):
+    print("{0:<26} {1:>10}".format("startup", "ms"))
+    for name, _ in SCENARIOS:
+        line = "{0:<26} {1:>10.1f}".format(name, figures[name])
+        if baseline and name in baseline:
+            line += "   ({0:+.0%})".format(
+                (figures[name] - baseline[name]) / baseline[name]
+            )
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME")
+    options = parser.parse_args()
+
+    baseline = None
+    if options.compare:
+        with open(os.path.join(
+            BASELINES_DIR, "startup-{0}.json".format(options.compare)
+        )) as f:
+            baseline = json.load(f)
+
+    figures = run_suite(options)
+    print_figures(figures, baseline)
+
+    if options.save:
+        if not os.path.isdir(BASELINES_DIR):
+            os.makedirs(BASELINES_DIR)
+        with open(os.path.join(
+            BASELINES_DIR, "startup-{0}.json".format(options.save)
+        ), "w") as f:
+            json.dump(figures, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
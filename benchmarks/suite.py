@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+"""Benchmark the database heavy paths of the app and the update lambda
+against a synthetic tournament in SQLite.
+
+Usage:
+    python benchmarks/suite.py [--users N] [--fixtures N] [--predictions N]
+                               [--repeat N] [--only NAME ...]
+                               [--save NAME] [--compare NAME]
+
+Each benchmark runs in its own process on a fresh copy of the database and
+reports the best wall time, the number of SQL statements per call and the
+growth in peak resident memory. --save writes the figures to
+benchmarks/baselines/NAME.json and --compare prints the change against a
+previously saved baseline, e.g. one saved on another commit.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(1, os.path.join(ROOT, "lambda"))
+
+from flask import Flask  # noqa
+from sqlalchemy import event  # noqa
+from sqlalchemy.orm import sessionmaker  # noqa
+
+import utils  # noqa
+import update_points  # noqa
+from models import db, User, Team, Prediction, Result, Fixture  # noqa
+
+BASELINES_DIR = os.path.join(ROOT, "benchmarks", "baselines")
+TEAMS = 24
+
+
+def create_app(db_path):
+    app = Flask(__name__)
+    app.config.update(
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SQLALCHEMY_DATABASE_URI="sqlite:///{0}".format(db_path)
+    )
+    db.init_app(app)
+    return app
+
+
+def get_games(fixtures):
+    # Fixtures are unique by (matchday, home team, away team) and the ids
+    # are their positions in this list, starting at 1
+    return [
+        (i // 12 + 1, "Team {0}".format(i % TEAMS),
+         "Team {0}".format((i + 1 + i // TEAMS) % TEAMS))
+        for i in range(fixtures)
+    ]
+
+
+def get_results(fixture_ids, seed=0):
+    rng = random.Random(seed)
+    return {
+        fixture_id: {
+            "home_score": rng.randint(0, 3),
+            "away_score": rng.randint(0, 3)
+        }
+        for fixture_id in fixture_ids
+    }
+
+
+def create_tournament(db_path, users, fixtures, predictions):
+    app = create_app(db_path)
+    games = get_games(fixtures)
+    rng = random.Random(42)
+    with app.app_context():
+        db.create_all()
+        utils.populate_teams_table([
+            ("Team {0}".format(i), "http://example.com/{0}.png".format(i))
+            for i in range(TEAMS)
+        ])
+        team_ids = [team_id for team_id, in db.session.query(Team.id)]
+        db.session.bulk_insert_mappings(Fixture, [
+            {
+                "id": fixture_id,
+                "matchday": matchday,
+                "home_team": home_team,
+                "away_team": away_team
+            }
+            for fixture_id, (matchday, home_team, away_team) in enumerate(
+                games, 1
+            )
+        ])
+        db.session.bulk_insert_mappings(User, [
+            {
+                "id": i + 1,
+                "email": "user-{0}@example.com".format(i),
+                "name": "User {0}".format(i),
+                "points": rng.randint(0, 100),
+                "allocated_team_id": team_ids[i % TEAMS]
+            }
+            for i in range(users)
+        ])
+        db.session.bulk_insert_mappings(Prediction, [
+            {
+                "user_id": user_id,
+                "fixture_id": fixture_id,
+                "home_score": rng.randint(0, 3),
+                "away_score": rng.randint(0, 3)
+            }
+            for user_id in range(1, users + 1)
+            for fixture_id in range(1, predictions + 1)
+        ])
+        db.session.bulk_insert_mappings(Result, [
+            {
+                "fixture_id": fixture_id,
+                "home_score": score["home_score"],
+                "away_score": score["away_score"]
+            }
+            for fixture_id, score in get_results(
+                range(1, fixtures // 2 + 1)
+            ).items()
+        ])
+        utils.sync_team_allocation_counts()
+        db.session.commit()
+
+
+def reset_caches():
+    utils._leaderboard_cache.clear()
+    utils._team_allocations_cache.clear()
+    utils._results_cache.clear()
+    utils._versions_cache.clear()
+    db.session.remove()
+
+
+def setup_set_predictions(options):
+    user = User.query.get(1)
+    calls = [0]
+
+    def run():
+        # Different scores every call so each one writes every row
+        calls[0] += 1
+        utils.set_predictions(user, [
+            {
+                "fixture_id": fixture_id,
+                "home_score": str(calls[0]),
+                "away_score": "0"
+            }
+            for fixture_id in range(1, options.fixtures + 1)
+        ])
+    return run
+
+
+def setup_get_points_for_user(options):
+    predictions = utils.load_user_profile("predictions", id=1).predictions
+
+    def run():
+        reset_caches()
+        utils.get_points_for_user(predictions)
+    return run
+
+
+def setup_get_predictions_leaderboard(options):
+    def run():
+        reset_caches()
+        utils.get_predictions_leaderboard()
+    return run
+
+
+def setup_get_team_allocations(options):
+    def run():
+        reset_caches()
+        utils.get_team_allocations()
+    return run
+
+
+def setup_allocate_team(options):
+    def run():
+        utils.allocate_team()
+        db.session.rollback()
+    return run
+
+
+def setup_load_user_profile(options):
+    def run():
+        db.session.remove()
+        utils.load_user_profile("predictions", id=1)
+    return run
+
+
+def setup_rebuild_points(options):
+    Session = sessionmaker(bind=db.engine)
+    calls = [0]
+
+    def run():
+        # New results every call so that most predictions are rescored. One
+        # worker, as SQLite only takes one writer at a time.
+        calls[0] += 1
+        update_points.rebuild_points(
+            Session, get_results(
+                range(1, options.fixtures + 1), seed=calls[0]
+            ), workers=1
+        )
+    return run
+
+
+def setup_update_results(options):
+    calls = [0]
+
+    def run():
+        # A new set of scores every call so every result is written
+        calls[0] += 1
+        update_points.update_results(
+            db.session, get_results(
+                range(1, options.fixtures + 1), seed=calls[0]
+            )
+        )
+        db.session.commit()
+    return run
+
+
+BENCHMARKS = [
+    ("set_predictions", setup_set_predictions),
+    ("get_points_for_user", setup_get_points_for_user),
+    ("get_predictions_leaderboard", setup_get_predictions_leaderboard),
+    ("get_team_allocations", setup_get_team_allocations),
+    ("allocate_team", setup_allocate_team),
+    ("load_user_profile", setup_load_user_profile),
+    ("rebuild_points", setup_rebuild_points),
+    ("update_results", setup_update_results)
+]
+
+
+def run_benchmark(setup, options, db_path, queue):
+    app = create_app(db_path)
+    with app.app_context():
+        run = setup(options)
+        statements = [0]
+        event.listen(
+            db.engine, "before_cursor_execute",
+            lambda *args: statements.__setitem__(0, statements[0] + 1)
+        )
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        timings = []
+        for _ in range(options.repeat):
+            start = time.time()
+            run()
+            timings.append(time.time() - start)
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({
+        "wall_ms": min(timings) * 1000,
+        "queries": statements[0] // options.repeat,
+        "peak_rss_kb": rss_after - rss_before
+    })
+
+
+def run_suite(options):
+    workdir = tempfile.mkdtemp(prefix="euro2016-benchmarks-")
+    template_path = os.path.join(workdir, "template.db")
+    db_path = os.path.join(workdir, "benchmark.db")
+    try:
+        create_tournament(
+            template_path, options.users, options.fixtures,
+            options.predictions
+        )
+        figures = {}
+        for name, setup in BENCHMARKS:
+            if options.only and name not in options.only:
+                continue
+            shutil.copy(template_path, db_path)
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=run_benchmark, args=(setup, options, db_path, queue)
+            )
+            process.start()
+            figures[name] = queue.get()
+            process.join()
+        return figures
+    finally:
+        shutil.rmtree(workdir)
+
+
+def print_figures(figures, baseline=None):
+    print("{0:<30} {1:>12} {2:>9} {3:>13}".format(
+        "benchmark", "wall (ms)", "queries", "peak rss (kb)"
+    ))
+    for name, _ in BENCHMARKS:
+        if name not in figures:
+            continue
+        row = figures[name]
+        line = "{0:<30} {1:>12.2f} {2:>9} {3:>13}".format(
+            name, row["wall_ms"], row["queries"], row["peak_rss_kb"]
+        )
+        if baseline and name in baseline:
+            before = baseline[name]
+            line += "   ({0:+.0%} time, {1:+d} queries)".format(
+                (row["wall_ms"] - before["wall_ms"]) / before["wall_ms"],
+                row["queries"] - before["queries"]
+            )
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--fixtures", type=int, default=51)
+    parser.add_argument(
+        "--predictions", type=int, default=51,
+        help="predictions per user, at most one per fixture"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs="+", metavar="NAME")
+    parser.add_argument("--save", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME")
+    options = parser.parse_args()
+    options.predictions = min(options.predictions, options.fixtures)
+
+    baseline = None
+    if options.compare:
+        with open(os.path.join(
+            BASELINES_DIR, "{0}.json".format(options.compare)
+        )) as f:
+            baseline = json.load(f)["figures"]
+
+    print("{0} users, {1} fixtures, {2} predictions per user".format(
+        options.users, options.fixtures, options.predictions
+    ))
+    figures = run_suite(options)
+    print_figures(figures, baseline)
+
+    if options.save:
+        if not os.path.isdir(BASELINES_DIR):
+            os.makedirs(BASELINES_DIR)
+        with open(os.path.join(
+            BASELINES_DIR, "{0}.json".format(options.save)
+        ), "w") as f:
+            json.dump({
+                "users": options.users,
+                "fixtures": options.fixtures,
+                "predictions": options.predictions,
+                "figures": figures
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Check that /sweepstakes issues a fixed number of SQL statements however
+many teams and users there are.
+
+Usage: python benchmarks/sweepstakes_queries.py
+
+Renders /sweepstakes with cold allocations and versions caches for
+tournaments of growing size in SQLite and counts the statements of each
+request. Exits with status 1 if any request issues more than
+MAX_STATEMENTS, or if the count grows with the number of teams.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from sqlalchemy import event  # noqa
+
+import app  # noqa
+import utils  # noqa
+from models import db, User, Team  # noqa
+from startup import CONFIG  # noqa
+
+# The logged in user, the versions and the allocations join
+MAX_STATEMENTS = 3
+TEAM_COUNTS = [8, 24, 96]
+USERS_PER_TEAM = 10
+
+
+def count_statements(workdir, teams):
+    config_path = os.path.join(workdir, "config-{0}.cfg".format(teams))
+    with open(config_path, "w") as f:
+        f.write(CONFIG.format(os.path.join(workdir, "{0}.db".format(teams))))
+    flask_app = app.create_app(config_path)
+    with flask_app.app_context():
+        db.create_all()
+        utils.populate_teams_table([
+            ("Team {0}".format(i), "http://example.com/{0}.png".format(i))
+            for i in range(teams)
+        ])
+        team_ids = [team_id for team_id, in db.session.query(Team.id)]
+        db.session.bulk_insert_mappings(User, [
+            {
+                "email": "user-{0}@example.com".format(i),
+                "name": "User {0}".format(i),
+                "points": 0,
+                "allocated_team_id": team_ids[i % teams]
+            }
+            for i in range(teams * USERS_PER_TEAM)
+        ])
+        db.session.commit()
+
+        statements = [0]
+        event.listen(
+            db.engine, "before_cursor_execute",
+            lambda *args: statements.__setitem__(0, statements[0] + 1)
+        )
+        client = flask_app.test_client()
+        with client.session_transaction() as session:
+            session["access_token"] = "benchmark"
+            session["user"] = {"email": "user-0@example.com"}
+        utils._team_allocations_cache.clear()
+        utils._versions_cache.clear()
+        response = client.get("/sweepstakes")
+        assert response.status_code == 200, response.data
+        return statements[0]
+
+
+def main():
+    utils.google_oauth2_client.is_access_token_valid = lambda token: True
+    workdir = tempfile.mkdtemp(prefix="euro2016-sweepstakes-")
+    try:
+        counts = [count_statements(workdir, teams) for teams in TEAM_COUNTS]
+    finally:
+        shutil.rmtree(workdir)
+
+    for teams, count in zip(TEAM_COUNTS, counts):
+        print("{0:>3} teams, {1:>4} users: {2} statements".format(
+            teams, teams * USERS_PER_TEAM, count
+        ))
+    ok = max(counts) <= MAX_STATEMENTS and len(set(counts)) == 1
+    print("OK" if ok else "FAIL: expected at most {0} statements, the same "
+          "for every size".format(MAX_STATEMENTS))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,23 @@
 #!/usr/bin/env python
 
+import sys
+import time
 import logging
 from pprint import pprint
 from ConfigParser import SafeConfigParser
+from multiprocessing.pool import ThreadPool
 
-from sqlalchemy import create_engine
+import numpy
+from sqlalchemy import create_engine, bindparam, and_
 from sqlalchemy.orm import sessionmaker
 
 from football_data_client import FootballDataApiClient
-from models import User, Result
+from models import User, Prediction, Result, Version, Fixture
+from scoring import score_predictions
+
+# Users rescored per transaction and number of chunks processed at once
+CHUNK_SIZE = 500
+WORKERS = 4
 
 
 def setup_logger():
@@ -24,95 +33,358 @@ def get_config(config_path):
     return config
 
 
-def get_db_session(db_url):
+def get_session_factory(db_url):
     engine = create_engine(db_url)
-    Session = sessionmaker(bind=engine)
-    return Session()
+    return sessionmaker(bind=engine)
+
+
+def get_db_session(db_url):
+    return get_session_factory(db_url)()
 
 
 def update_results(session, results):
-    for game in results:
-        try:
-            result = session.query(Result).filter_by(
-                matchday=game.split("_")[0],
-                home_team=game.split("_")[1],
-                away_team=game.split("_")[2]
-            ).first()
-            if not result:
-                result = Result(
-                    matchday=game.split("_")[0],
-                    home_team=game.split("_")[1],
-                    home_score=results[game]["home_score"],
-                    away_team=game.split("_")[2],
-                    away_score=results[game]["away_score"]
-                )
-            else:
-                result.home_score = results[game]["home_score"]
-                result.away_score = results[game]["away_score"]
-            session.add(result)
-            session.commit()
-        except:
-            session.rollback()
-
-
-def calculate_points(predictions, results):
-    points = 0
-    for prediction in predictions:
-        game = prediction.get_key()
-        if game in results:
-            predicted_score = prediction.get_value()
-            if (
-                predicted_score["home_score"] == results[game]["home_score"] and  # noqa
-                predicted_score["away_score"] == results[game]["away_score"]
-            ):
-                points += 3
-            elif (
-                predicted_score["home_score"] == predicted_score["away_score"] and  # noqa
-                results[game]["home_score"] == results[game]["away_score"]
-            ):
-                points += 1
-            elif (
-                predicted_score["home_score"] > predicted_score["away_score"] and  # noqa
-                results[game]["home_score"] > results[game]["away_score"]
-            ):
-                points += 1
-            elif (
-                predicted_score["home_score"] < predicted_score["away_score"] and  # noqa
-                results[game]["home_score"] < results[game]["away_score"]
-            ):
-                points += 1
-    return points
+    """Write the results that were added or changed since the last run, as
+    not yet scored, and bump the results version in the same transaction.
+    Returns the ids of those fixtures.
+    """
+    existing_results = {
+        fixture_id: (home_score, away_score)
+        for fixture_id, home_score, away_score in session.query(
+            Result.fixture_id, Result.home_score, Result.away_score
+        )
+    }
+
+    inserts = []
+    updates = []
+    for fixture_id, score in results.items():
+        row = {
+            "fixture_id": fixture_id,
+            "home_score": score["home_score"],
+            "away_score": score["away_score"],
+            "scored": False
+        }
+        existing_score = existing_results.get(fixture_id)
+        if existing_score is None:
+            inserts.append(row)
+        elif existing_score != (score["home_score"], score["away_score"]):
+            updates.append(row)
+
+    try:
+        if inserts:
+            session.bulk_insert_mappings(Result, inserts)
+        if updates:
+            session.bulk_update_mappings(Result, updates)
+        if inserts or updates:
+            # Lets the web tier know its cached results are out of date
+            Version.bump(session, "results")
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return set(row["fixture_id"] for row in inserts + updates)
+
+
+def get_fixture_results(session, football_api_client):
+    """Add any new fixtures from the feed and return its results keyed by
+    fixture id.
+    """
+    fixture_index = football_api_client.get_fixture_index()
+    fixture_ids = Fixture.sync(
+        session, [fixture.key for fixture in fixture_index.fixtures]
+    )
+    return {
+        fixture_ids[key]: score
+        for key, score in football_api_client.get_results().items()
+    }
+
+
+def score_rows(rows, results):
+    """Score prediction rows of (id, user id, fixture id, home score, away
+    score, points) against ``results``, keyed by fixture id.
+
+    The rows are turned into one array and scored column-wise. Returns the
+    id, user id and stored points columns, and the new points of each row,
+    which is 0 when its fixture has no result.
+    """
+    columns = numpy.array(rows, dtype=numpy.int64).reshape(len(rows), 6)
+    ids, owners, fixture_ids, home_scores, away_scores, points = columns.T
+
+    # Results as columns indexed by fixture id
+    size = int(fixture_ids.max()) + 1 if len(rows) else 1
+    has_result = numpy.zeros(size, dtype=bool)
+    result_home = numpy.zeros(size, dtype=numpy.int64)
+    result_away = numpy.zeros(size, dtype=numpy.int64)
+    for fixture_id, score in results.items():
+        if fixture_id < size:
+            has_result[fixture_id] = True
+            result_home[fixture_id] = score["home_score"]
+            result_away[fixture_id] = score["away_score"]
+
+    scored = has_result[fixture_ids]
+    new_points = numpy.zeros(len(rows), dtype=numpy.int64)
+    new_points[scored] = score_predictions(
+        home_scores[scored], away_scores[scored],
+        result_home[fixture_ids[scored]], result_away[fixture_ids[scored]]
+    )
+    return ids, owners, points, new_points
+
+
+def sum_by_owner(owner_index, values):
+    # Float weights are exact for any realistic points total
+    return numpy.bincount(owner_index, weights=values).astype(
+        numpy.int64
+    ).tolist()
+
+
+def update_points_chunk(Session, results, user_ids, games=None):
+    """Rescore the predictions of ``user_ids`` in one short transaction.
+
+    With ``games``, a collection of fixture ids, only the predictions for
+    those games are rescored and user totals are adjusted by the
+    difference, otherwise every prediction is rescored and totals are
+    recomputed from scratch.
+    """
+    session = Session()
+    try:
+        query = session.query(
+            Prediction.id, Prediction.user_id, Prediction.fixture_id,
+            Prediction.home_score, Prediction.away_score, Prediction.points
+        ).filter(Prediction.user_id.in_(user_ids))
+        if games is not None:
+            query = query.filter(Prediction.fixture_id.in_(games))
+        ids, owners, old_points, new_points = score_rows(
+            query.all(), results
+        )
+
+        changed = new_points != old_points
+        changed_predictions = [
+            {"prediction_id": prediction_id, "new_points": points}
+            for prediction_id, points in zip(
+                ids[changed].tolist(), new_points[changed].tolist()
+            )
+        ]
+        owner_ids, owner_index = numpy.unique(owners, return_inverse=True)
+        owner_ids = owner_ids.tolist()
+        totals = dict.fromkeys(user_ids, 0)
+        totals.update(zip(owner_ids, sum_by_owner(owner_index, new_points)))
+        deltas = {
+            user_id: delta for user_id, delta in zip(
+                owner_ids, sum_by_owner(owner_index, new_points - old_points)
+            ) if delta
+        }
+
+        predictions_table = Prediction.__table__
+        users_table = User.__table__
+        if changed_predictions:
+            session.execute(
+                predictions_table.update().where(
+                    predictions_table.c.id == bindparam("prediction_id")
+                ).values(points=bindparam("new_points")),
+                changed_predictions
+            )
+        if games is None:
+            session.execute(
+                users_table.update().where(
+                    users_table.c.id == bindparam("user_id")
+                ).values(points=bindparam("new_points")),
+                [
+                    {"user_id": user_id, "new_points": total}
+                    for user_id, total in totals.items()
+                ]
+            )
+        elif deltas:
+            session.execute(
+                users_table.update().where(
+                    users_table.c.id == bindparam("user_id")
+                ).values(points=users_table.c.points + bindparam("delta")),
+                [
+                    {"user_id": user_id, "delta": delta}
+                    for user_id, delta in deltas.items()
+                ]
+            )
+        session.commit()
+        return len(user_ids)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def update_points_in_chunks(Session, results, user_ids, games=None,
+                            chunk_size=CHUNK_SIZE, workers=WORKERS):
+    chunks = [
+        user_ids[i:i + chunk_size]
+        for i in range(0, len(user_ids), chunk_size)
+    ]
+    # Threads rather than processes as Lambda has no /dev/shm, each chunk
+    # mostly waits on the database anyway
+    pool = ThreadPool(workers)
+    try:
+        return sum(pool.imap_unordered(
+            lambda chunk: update_points_chunk(Session, results, chunk, games),
+            chunks
+        ))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def update_points(Session, results, games, **kwargs):
+    """Rescore only the predictions for ``games`` and apply the difference
+    to each affected user's total. Returns the number of users updated.
+    """
+    if not games:
+        return 0
+    session = Session()
+    try:
+        user_ids = [
+            user_id for user_id, in session.query(
+                Prediction.user_id
+            ).filter(Prediction.fixture_id.in_(games)).distinct()
+        ]
+    finally:
+        session.close()
+    return update_points_in_chunks(
+        Session, results, sorted(user_ids), games, **kwargs
+    )
+
+
+def rebuild_points(Session, results, **kwargs):
+    """Rescore every prediction and recompute every total from scratch.
+    Returns the number of users updated.
+    """
+    session = Session()
+    try:
+        user_ids = [
+            user_id for user_id, in session.query(User.id).order_by(User.id)
+        ]
+    finally:
+        session.close()
+    return update_points_in_chunks(Session, results, user_ids, **kwargs)
+
+
+def get_stored_results(session, unscored_only=False):
+    """The results in the database keyed by fixture id, or only those whose
+    predictions haven't been scored against them yet.
+    """
+    query = session.query(
+        Result.fixture_id, Result.home_score, Result.away_score
+    )
+    if unscored_only:
+        query = query.filter(Result.scored.is_(False))
+    return {
+        fixture_id: {"home_score": home_score, "away_score": away_score}
+        for fixture_id, home_score, away_score in query
+    }
+
+
+def mark_results_scored(session, results):
+    if not results:
+        return
+    # Only where the score is still the one that was scored, so a result
+    # corrected by another run meanwhile is scored again
+    results_table = Result.__table__
+    session.execute(
+        results_table.update().where(and_(
+            results_table.c.fixture_id == bindparam("fixture"),
+            results_table.c.home_score == bindparam("home"),
+            results_table.c.away_score == bindparam("away")
+        )).values(scored=True),
+        [
+            {
+                "fixture": fixture_id,
+                "home": score["home_score"],
+                "away": score["away_score"]
+            }
+            for fixture_id, score in results.items()
+        ]
+    )
+
+
+def score_results(Session, full_rebuild=False, **kwargs):
+    """Score the predictions for the stored results that haven't been
+    scored yet, or rebuild every prediction's points with
+    ``full_rebuild``. The results are then marked as scored and the points
+    version bumped in one transaction, so a run that fails part way leaves
+    them for the next one to finish. Returns the number of users updated.
+    """
+    session = Session()
+    try:
+        results = get_stored_results(session, unscored_only=not full_rebuild)
+    finally:
+        session.close()
+    if full_rebuild:
+        users = rebuild_points(Session, results, **kwargs)
+    elif results:
+        users = update_points(Session, results, set(results), **kwargs)
+    else:
+        return 0
+
+    session = Session()
+    try:
+        mark_results_scored(session, results)
+        # Lets the web tier know its cached leaderboard is out of date
+        Version.bump(session, "points")
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return users
 
 
 def lambda_handler(event, context):
+    event = event or {}
     logger = setup_logger()
     config = get_config("./config.cfg")
-    session = get_db_session(config.get("db", "sqlalchemy_db_url"))
+    Session = get_session_factory(config.get("db", "sqlalchemy_db_url"))
+    session = Session()
     football_api_client = FootballDataApiClient(
         config.get("football_data", "api_key"), 424
     )
 
-    # Get game results
-    results = football_api_client.get_results()
-    logger.info("Results are:")
-    pprint(results)
+    try:
+        # Get game results
+        results = get_fixture_results(session, football_api_client)
+        logger.info("Results are:")
+        pprint(results)
 
-    # Update results
-    update_results(session, results)
+        # Update results
+        changed_games = update_results(session, results)
+        logger.info("Changed results: {}".format(sorted(changed_games)))
 
-    # Update points
-    users = session.query(User).all()
-    for user in users:
-        logger.info("Updating points for {}".format(user.name))
-        user.points = calculate_points(user.predictions, results)
-    try:
-        logger.info("Committing points update")
-        session.commit()
+        # Update points for these and any results a failed run didn't finish
+        start = time.time()
+        if event.get("full_rebuild"):
+            logger.info("Rebuilding points for all predictions")
+        users = score_results(
+            Session, bool(event.get("full_rebuild")),
+            chunk_size=event.get("chunk_size", CHUNK_SIZE),
+            workers=event.get("workers", WORKERS)
+        )
+        elapsed = time.time() - start
+        throughput = users / elapsed if elapsed else 0
+        logger.info(
+            "Updated points for {0} users in {1:.2f}s ({2:.0f} users/sec)"
+            .format(users, elapsed, throughput)
+        )
         logger.info("Success!")
+        return {
+            "changed_results": len(changed_games),
+            "users": users,
+            "seconds": elapsed,
+            "users_per_second": throughput
+        }
     except Exception as e:
         session.rollback()
         logger.exception(e)
+        # Fail the invocation so the error shows up in Lambda's metrics
+        raise
+    finally:
+        session.close()
 
 
 if __name__ == "__main__":
-    lambda_handler(None, None)
+    lambda_handler({"full_rebuild": "--full-rebuild" in sys.argv}, None)
@@ -1,63 +1,119 @@
-from dateutil.parser import parse as parse_date
-
-from flask import Flask, request, flash, session, jsonify, redirect, url_for, \
-    render_template
+from flask import Blueprint, request, flash, session, jsonify, redirect, \
+    url_for, render_template, Markup, Response, stream_with_context, \
+    current_app
 from flask_oauth2_login import GoogleLogin
+from werkzeug.local import LocalProxy
 
-from football_data_client import FootballDataApiClient
-
-from models import db
-from utils import get_config, is_user_logged_in, is_valid_email_domain, \
-    add_user, set_predictions, populate_teams_table, get_user_count, \
-    get_team_allocations, get_predictions_leaderboard, get_user_information, \
-    get_current_time, get_points_for_user, convert_submit_form_to_dict
-
-config = get_config("./config/config.cfg")
-
-app = Flask(__name__)
-app.config.update(
-    SECRET_KEY=config.get("flask", "secret_key"),
-    GOOGLE_LOGIN_REDIRECT_SCHEME=config.get("google_login", "redirect_scheme"),
-    GOOGLE_LOGIN_CLIENT_ID=config.get("google_login", "client_id"),
-    GOOGLE_LOGIN_CLIENT_SECRET=config.get("google_login", "client_secret"),
-    SQLALCHEMY_TRACK_MODIFICATIONS=False,
-    SQLALCHEMY_DATABASE_URI=config.get("db", "sqlalchemy_db_url")
-)
+import metrics
 
-google_login = GoogleLogin(app)
-db.init_app(app)
+from cache import LRUCache
+from export import generate_csv, generate_json
+from football_data_client import FootballDataApiClient
+from live_updates import LiveUpdates, can_stream
+
+from migrations import upgrade_schema
+from utils import CONFIG_PATH, get_config, create_db_app, \
+    is_user_logged_in, is_valid_email_domain, add_user, set_predictions, \
+    populate_teams_table, get_user_count, get_team_allocations, \
+    get_predictions_leaderboard, get_user_information, get_current_time, \
+    get_points_for_user, convert_submit_form_to_dict, get_results_version, \
+    google_oauth2_client, iter_leaderboard, iter_predictions, \
+    get_fixture_index, populate_fixtures_table
+
+LEADERBOARD_PAGE_SIZE = 50
+PREDICTION_ROWS_CACHE_SIZE = 256
+# Longest a request waits on football-data's rate limit before failing
+FOOTBALL_DATA_MAX_WAIT = 5
+
+EXPORTS = {
+    "leaderboard": (
+        ["rank", "user_id", "name", "points"], iter_leaderboard
+    ),
+    "predictions": (
+        ["user_id", "name", "matchday", "home_team", "home_score",
+         "away_team", "away_score", "points"],
+        iter_predictions
+    )
+}
+EXPORT_FORMATS = {
+    "csv": (generate_csv, "text/csv"),
+    "json": (generate_json, "application/json")
+}
+
+google_login = GoogleLogin()
+views = Blueprint("views", __name__)
+
+# Rendered prediction rows of other users' pages, keyed by everything the
+# rows depend on so that new predictions or results simply miss the cache
+prediction_rows_cache = LRUCache(PREDICTION_ROWS_CACHE_SIZE)
+
+metrics.instrument_session(google_oauth2_client.requests, "google_oauth2")
+
+
+def create_app(config_path=CONFIG_PATH):
+    """Build the web app. This only registers things with Flask: the
+    database engine, the football-data client and the live updates poller
+    are created on first use so that creating the app, e.g. once in the
+    gunicorn master before forking workers, stays cheap and shares no
+    connections or threads.
+    """
+    config = get_config(config_path)
+    app = create_db_app(config, __name__)
+    app.config.update(
+        SECRET_KEY=config.get("flask", "secret_key"),
+        GOOGLE_LOGIN_REDIRECT_SCHEME=config.get(
+            "google_login", "redirect_scheme"
+        ),
+        GOOGLE_LOGIN_CLIENT_ID=config.get("google_login", "client_id"),
+        GOOGLE_LOGIN_CLIENT_SECRET=config.get(
+            "google_login", "client_secret"
+        ),
+        WHITELISTED_DOMAINS=config.get("google_login", "whitelisted_domains")
+    )
+    app.extensions["football_data"] = {"config": config, "client": None}
+    app.extensions["live_updates"] = LiveUpdates(app)
 
-football_api_client = FootballDataApiClient(
-    config.get("football_data", "api_key"), 424
-)
+    google_login.init_app(app)
+    metrics.init_app(app)
+    app.register_blueprint(views)
+    return app
 
 
-@app.template_filter("strftime")
-def strftime(date_time):
-    date_time_object = parse_date(date_time)
-    return date_time_object.strftime("%a %d %B %Y - %H:%M UTC")
+def get_football_api_client():
+    state = current_app.extensions["football_data"]
+    if state["client"] is None:
+        client = FootballDataApiClient.from_config(
+            state["config"], max_wait=FOOTBALL_DATA_MAX_WAIT
+        )
+        metrics.instrument_session(client.requests, "football_data")
+        state["client"] = client
+    return state["client"]
 
 
-@app.template_filter("convert_to_datetime")
-def convert_to_datetime(date_time):
-    return parse_date(date_time)
+football_api_client = LocalProxy(get_football_api_client)
 
 
-@app.errorhandler(Exception)
+@views.app_errorhandler(Exception)
 def error(error):
     return jsonify(error=str(error)), 500
 
 
-@app.route("/status")
+@views.route("/status")
 def status():
     return jsonify(response="OK")
 
 
-@app.route("/")
+@views.route("/metrics")
+def metrics_endpoint():
+    data, content_type = metrics.generate_metrics()
+    return data, 200, {"Content-Type": content_type}
+
+
+@views.route("/")
 def index():
     is_logged_in, user = is_user_logged_in(session)
     if is_logged_in:
-        return redirect(url_for("my_predictions"))
+        return redirect(url_for("views.my_predictions"))
     if session.get("seen"):
         return redirect(google_login.authorization_url())
     user_count = get_user_count()
@@ -68,84 +124,161 @@ def index():
     )
 
 
-@app.route("/my-predictions")
+@views.route("/my-predictions")
 def my_predictions():
-    is_logged_in, user = is_user_logged_in(session)
+    is_logged_in, user = is_user_logged_in(session, "predictions")
     if not is_logged_in:
-        return redirect(url_for("index"))
-    user_info = user.to_json()
+        return redirect(url_for("views.index"))
+    fixture_index = get_fixture_index(football_api_client)
     return render_template(
         "my-predictions.html",
-        user=user_info,
-        fixtures=football_api_client.get_all_fixtures(),
-        points=get_points_for_user(user_info["predictions"]),
-        current_time=get_current_time()
+        user=user,
+        fixtures=fixture_index.fixtures,
+        points=get_points_for_user(user.predictions),
+        open_fixtures=fixture_index.get_open_fixtures(get_current_time())
     )
 
 
-@app.route("/submit", methods=["POST"])
+@views.route("/submit", methods=["POST"])
 def submit():
     is_logged_in, user = is_user_logged_in(session)
     if not is_logged_in:
-        return redirect(url_for("index"))
-    predictions = convert_submit_form_to_dict(request.form)
+        return redirect(url_for("views.index"))
     try:
-        football_api_client.check_predictions_validity(predictions)
-        set_predictions(user, predictions)
+        predictions = convert_submit_form_to_dict(request.form)
+        football_api_client.check_predictions_validity(
+            predictions, get_current_time(),
+            get_fixture_index(football_api_client)
+        )
+        counts = set_predictions(user, predictions)
+        current_app.logger.info(
+            "Saved predictions for user {0}: {1[inserted]} inserted, "
+            "{1[updated]} updated, {1[unchanged]} unchanged".format(
+                user.id, counts
+            )
+        )
         flash("Your predictions were successfully saved!", "info")
     except Exception as e:
         flash(str(e), "danger")
-    return redirect(url_for("my_predictions"))
+    return redirect(url_for("views.my_predictions"))
 
 
-@app.route("/user/<int:user_id>")
+@views.route("/user/<int:user_id>")
 def user(user_id):
     is_logged_in, user = is_user_logged_in(session)
     if not is_logged_in:
-        return redirect(url_for("index"))
-    other_user_info = get_user_information(user_id).to_json()
+        return redirect(url_for("views.index"))
+    other_user = get_user_information(user_id, "team")
+    fixture_index = get_fixture_index(football_api_client)
+    cache_key = (
+        other_user.id,
+        other_user.predictions_version,
+        get_results_version(),
+        football_api_client.fixture_index_version,
+        fixture_index.missing_ids
+    )
+    prediction_rows = prediction_rows_cache.get(cache_key)
+    if prediction_rows is None:
+        other_user = get_user_information(user_id)
+        prediction_rows = Markup(render_template(
+            "prediction-rows.html",
+            user=other_user,
+            fixtures=fixture_index.fixtures,
+            points=get_points_for_user(other_user.predictions),
+            other_user=other_user,
+            open_fixtures=set()
+        ))
+        prediction_rows_cache.set(cache_key, prediction_rows)
     return render_template(
         "my-predictions.html",
-        user=user.to_json(),
-        fixtures=football_api_client.get_all_fixtures(),
-        points=get_points_for_user(other_user_info["predictions"]),
-        other_user=other_user_info,
-        current_time=get_current_time()
+        user=user,
+        other_user=other_user,
+        prediction_rows=prediction_rows
     )
 
 
-@app.route("/sweepstakes")
+@views.route("/sweepstakes")
 def sweepstakes():
     is_logged_in, user = is_user_logged_in(session)
     if not is_logged_in:
-        return redirect(url_for("index"))
+        return redirect(url_for("views.index"))
     return render_template(
         "sweepstakes.html",
-        user=user.to_json(),
+        user=user,
         allocations=get_team_allocations()
     )
 
 
-@app.route("/predictions")
+@views.route("/predictions")
 def predictions():
     is_logged_in, user = is_user_logged_in(session)
     if not is_logged_in:
-        return redirect(url_for("index"))
+        return redirect(url_for("views.index"))
+    leaderboard = get_predictions_leaderboard()
+    page_count = leaderboard.get_page_count(LEADERBOARD_PAGE_SIZE)
+    page = min(max(request.args.get("page", 1, type=int), 1), page_count)
     return render_template(
         "predictions.html",
-        user=user.to_json(),
-        leaderboard=get_predictions_leaderboard()
+        user=user,
+        leaderboard=leaderboard.get_page(page, LEADERBOARD_PAGE_SIZE),
+        user_rank=leaderboard.get_rank(user.id),
+        page=page,
+        page_count=page_count
+    )
+
+
+@views.route("/updates")
+def updates():
+    is_logged_in, user = is_user_logged_in(session, "predictions")
+    if not is_logged_in:
+        return Response(status=401)
+    if not can_stream(request.environ):
+        # A 204 tells the browser to stop reconnecting, pages then only
+        # update when reloaded
+        return Response(status=204)
+    live_updates = current_app.extensions["live_updates"]
+    live_updates.start()
+    # Without stream_with_context the request, and its database session,
+    # ends before the stream starts, so subscribers hold no connection
+    return Response(
+        live_updates.stream(
+            request.headers.get("Last-Event-ID"), user.predictions, user.id,
+            request.args.get("page", type=int), LEADERBOARD_PAGE_SIZE
+        ),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@views.route(
+    "/export/<any(leaderboard, predictions):dataset>."
+    "<any(csv, json):export_format>"
+)
+def export(dataset, export_format):
+    is_logged_in, user = is_user_logged_in(session)
+    if not is_logged_in:
+        return redirect(url_for("views.index"))
+    columns, iter_rows = EXPORTS[dataset]
+    generate, mimetype = EXPORT_FORMATS[export_format]
+    return Response(
+        stream_with_context(generate(columns, iter_rows())),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": "attachment; filename={0}.{1}".format(
+                dataset, export_format
+            )
+        }
     )
 
 
 @google_login.login_success
 def login_success(token, profile):
-    whitelisted_domains = config.get("google_login", "whitelisted_domains")
+    whitelisted_domains = current_app.config["WHITELISTED_DOMAINS"]
     if not is_valid_email_domain(profile.get("hd"), whitelisted_domains):
         return jsonify(error="Please use a valid email address!")
     add_user(session, token, profile)
     session["seen"] = True
-    return redirect(url_for("my_predictions"))
+    return redirect(url_for("views.my_predictions"))
 
 
 @google_login.login_failure
@@ -154,8 +287,11 @@ def login_failure(error):
 
 
 if __name__ == "__main__":
+    app = create_app()
     google_login.redirect_scheme = "http"
     with app.app_context():
-        db.create_all()
-        populate_teams_table(football_api_client.get_all_teams())
+        upgrade_schema()
+        teams, _ = football_api_client.prefetch()
+        populate_teams_table(teams)
+        populate_fixtures_table(football_api_client.get_fixture_index())
     app.run(port=8000, debug=True)
@@ -1,10 +1,47 @@
+import os
+import shutil
 import multiprocessing
 
 user = "nobody"
 group = "nobody"
 bind = "unix:/tmp/gunicorn.sock"
 workers = multiprocessing.cpu_count() * 2 + 1
+# "sync" or "gevent". gevent workers patch sockets so that a request waiting
+# on Google or football-data yields to the others instead of tying up the
+# whole worker. MySQL calls still block as mysqlclient is a C extension.
+worker_class = os.environ.get("EURO2016_WORKER_CLASS", "sync")
 max_requests = 10
+if worker_class == "gevent":
+    workers = multiprocessing.cpu_count() + 1
+    # Browsers subscribed to /updates each keep a connection open, mostly
+    # idle, and count as one request each towards max_requests
+    worker_connections = 2000
+    max_requests = 1000
+    max_requests_jitter = 100
+# Import and create the app once in the master so that workers, which are
+# recycled every max_requests, start by forking instead of re-importing.
+# Database connections and upstream clients are only created in workers.
+preload_app = True
 daemon = True
 accesslog = "/var/log/euro2016-access.log"
 errorlog = "/var/log/euro2016-error.log"
+
+# Workers share their metrics through files in this directory so /metrics
+# reports totals for the whole server rather than a single worker.
+# prometheus_client picks where to keep samples when it is first imported,
+# and preload_app imports the app, which opens its sample files, before any
+# server hook runs. So the directory is set up here, as the config loads.
+METRICS_DIR = os.environ.get("EURO2016_METRICS_DIR", "/tmp/euro2016-metrics")
+os.environ["PROMETHEUS_MULTIPROC_DIR"] = METRICS_DIR
+shutil.rmtree(METRICS_DIR, ignore_errors=True)
+os.makedirs(METRICS_DIR)
+
+
+def on_starting(server):
+    # Before the workers, which drop to user and group, are forked
+    os.chown(METRICS_DIR, server.cfg.uid, server.cfg.gid)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,14 +1,27 @@
 #!/usr/bin/env python
 
-import app as euro2016
+import logging
+
+from football_data_client import FootballDataApiClient
+from migrations import upgrade_schema
+from utils import CONFIG_PATH, get_config, create_db_app, \
+    populate_teams_table, populate_fixtures_table, \
+    sync_team_allocation_counts
 
 
 def main():
-    with euro2016.app.app_context():
-        euro2016.db.create_all()
-        euro2016.populate_teams_table(
-            euro2016.football_api_client.get_all_teams()
-        )
+    # Only the database and the football-data client, not the web app
+    logging.basicConfig(level=logging.INFO)
+    config = get_config(CONFIG_PATH)
+    app = create_db_app(config)
+    football_api_client = FootballDataApiClient.from_config(config)
+    with app.app_context():
+        upgrade_schema()
+        # Also warms the fixtures snapshot for the first page views
+        teams, _ = football_api_client.prefetch()
+        populate_teams_table(teams)
+        populate_fixtures_table(football_api_client.get_fixture_index())
+        sync_team_allocation_counts()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,30 @@
+import csv
+import json
+
+from StringIO import StringIO
+from collections import OrderedDict
+
+
+def generate_csv(columns, rows):
+    """Yield ``rows`` as CSV lines, one at a time, after a header line."""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([
+            value.encode("utf-8") if isinstance(value, unicode) else value
+            for value in row
+        ])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def generate_json(columns, rows):
+    """Yield ``rows`` as a JSON array of objects, one object at a time."""
+    separator = "["
+    for row in rows:
+        yield separator + json.dumps(OrderedDict(zip(columns, row)))
+        separator = ",\n"
+    yield "[]" if separator == "[" else "]"
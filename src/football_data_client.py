@@ -1,23 +1,377 @@
+import os
+import json
+import time
+import fcntl
+import bisect
+import tempfile
+import threading
+
+from datetime import datetime
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from dateutil.parser import parse as parse_date
+from dateutil.tz import tzutc
+
+
+def give_to_directory_owner(fd, path):
+    """Hand a file that root created, e.g. while create_db_tables.py warms
+    up the client, to the owner of its directory: the user the workers run
+    as, who have to be able to write it too.
+    """
+    if os.geteuid() == 0:
+        directory = os.stat(os.path.dirname(os.path.abspath(path)))
+        os.fchown(fd, directory.st_uid, directory.st_gid)
+
+
+class RateLimitExceeded(requests.RequestException):
+    """The call would have had to wait longer than allowed for the rate
+    limit.
+    """
+
+
+class RateLimiter(object):
+    """Token bucket shared by every process on a host via a JSON state file.
+
+    Allows ``rate`` requests per ``per`` seconds with bursts of up to
+    ``rate``, and can be told by the API to hold off until a given time.
+    """
+
+    def __init__(self, path, rate=50, per=60):
+        self.path = path
+        self.rate = float(rate)
+        self.per = float(per)
+
+    def _update(self, update):
+        with open(self.path, "a+") as f:
+            give_to_directory_owner(f.fileno(), self.path)
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    state = {
+                        "tokens": self.rate,
+                        "updated_at": time.time(),
+                        "blocked_until": 0
+                    }
+                now = time.time()
+                state["tokens"] = min(
+                    self.rate,
+                    state["tokens"] +
+                    (now - state["updated_at"]) * self.rate / self.per
+                )
+                state["updated_at"] = now
+                result = update(state, now)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def try_acquire(self):
+        """Take a token and return 0, or return the seconds to wait."""
+        def take(state, now):
+            if state["blocked_until"] > now:
+                return state["blocked_until"] - now
+            if state["tokens"] < 1:
+                return (1 - state["tokens"]) * self.per / self.rate
+            state["tokens"] -= 1
+            return 0
+        return self._update(take)
+
+    def acquire(self, max_wait=None):
+        """Wait for a token. Returns False straight away, without taking one,
+        if that would mean waiting more than ``max_wait`` seconds in all.
+        """
+        deadline = None if max_wait is None else time.time() + max_wait
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            if deadline is not None and time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def update_from_api(self, available, reset_in):
+        """Sync the bucket with the quota the API reports as left."""
+        def sync(state, now):
+            if available is not None:
+                state["tokens"] = min(state["tokens"], available)
+                if available <= 0 and reset_in is not None:
+                    state["blocked_until"] = now + reset_in
+        self._update(sync)
+
+
+class FixtureSnapshotStore(object):
+    """Fixtures document shared by every process on a host via a JSON file.
+
+    The file is replaced atomically so readers never see a partial write,
+    and is refreshed in a background thread with conditional requests once
+    it is older than ``max_staleness`` seconds.
+    """
+
+    def __init__(self, path, max_staleness=300):
+        self.path = path
+        self.lock_path = "{0}.lock".format(path)
+        self.max_staleness = max_staleness
+        self._snapshot = None
+        self._mtime = None
+        self._refreshing = threading.Lock()
+
+    def read(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return None
+        if mtime != self._mtime:
+            with open(self.path) as f:
+                self._snapshot = json.load(f)
+            self._mtime = mtime
+        return self._snapshot
+
+    def write(self, snapshot):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        # mkstemp only lets its creator read the file
+        os.fchmod(fd, 0o644)
+        give_to_directory_owner(fd, self.path)
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot, f)
+        os.rename(tmp_path, self.path)
+
+    def is_stale(self, snapshot):
+        return time.time() - snapshot["fetched_at"] > self.max_staleness
+
+    def refresh(self, fetch):
+        """Refresh the snapshot unless another process on the host already is.
+
+        ``fetch`` is called with the current snapshot (or None) and must
+        return the new snapshot, or None if the upstream copy is unchanged.
+        """
+        with open(self.lock_path, "a") as lock_file:
+            give_to_directory_owner(lock_file.fileno(), self.lock_path)
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return
+            try:
+                current = self.read()
+                if current is not None and not self.is_stale(current):
+                    return
+                snapshot = fetch(current)
+                if snapshot is None:
+                    snapshot = dict(current, fetched_at=time.time())
+                self.write(snapshot)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def refresh_in_background(self, fetch):
+        if not self._refreshing.acquire(False):
+            return
+
+        def run():
+            try:
+                self.refresh(fetch)
+            except Exception:
+                # Keep serving the previous snapshot, retry on next access
+                pass
+            finally:
+                self._refreshing.release()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+
+FixtureRecord = namedtuple("FixtureRecord", [
+    "id", "key", "matchday", "home_team", "away_team", "kick_off",
+    "kick_off_display", "status"
+])
+
+
+class FixtureIndex(object):
+    """Fixtures parsed once per snapshot into FixtureRecords, keyed by
+    (matchday, home team, away team), plus a kick-off ordered timeline for
+    open game lookups. The records' ids are those of the fixtures table,
+    filled in with set_ids().
+    """
+
+    def __init__(self, fixtures):
+        self.fixtures = []
+        self._fixtures = {}
+        timeline = []
+        for fixture in fixtures:
+            kick_off = parse_date(fixture["date"]).astimezone(tzutc())
+            record = FixtureRecord(
+                id=None,
+                key=(
+                    fixture["matchday"],
+                    fixture["homeTeamName"],
+                    fixture["awayTeamName"]
+                ),
+                matchday=fixture["matchday"],
+                home_team=fixture["homeTeamName"],
+                away_team=fixture["awayTeamName"],
+                kick_off=kick_off,
+                kick_off_display=kick_off.strftime("%a %d %B %Y - %H:%M UTC"),
+                status=fixture["status"]
+            )
+            self.fixtures.append(record)
+            self._fixtures[record.key] = record
+            timeline.append((kick_off, record.key))
+        timeline.sort()
+        self._kick_offs = [entry[0] for entry in timeline]
+        self._timeline_keys = [entry[1] for entry in timeline]
+        self._fixtures_by_id = {}
+        self.missing_ids = len(self.fixtures)
+
+    def set_ids(self, ids):
+        """Fill in the ids of the records from a {key: id} mapping."""
+        self.fixtures = [
+            fixture._replace(id=ids.get(fixture.key))
+            for fixture in self.fixtures
+        ]
+        self._fixtures = {fixture.key: fixture for fixture in self.fixtures}
+        self._fixtures_by_id = {
+            fixture.id: fixture for fixture in self.fixtures
+            if fixture.id is not None
+        }
+        self.missing_ids = len(self.fixtures) - len(self._fixtures_by_id)
+
+    def get(self, matchday, home_team, away_team):
+        return self._fixtures.get((matchday, home_team, away_team))
+
+    def get_by_id(self, fixture_id):
+        return self._fixtures_by_id.get(fixture_id)
+
+    def get_open_fixtures(self, at_time):
+        index = bisect.bisect_right(self._kick_offs, at_time)
+        return set(
+            key for key in self._timeline_keys[index:]
+            if self._fixtures[key].status != "FINISHED"
+        )
+
+    def is_open(self, fixture, at_time):
+        return at_time < fixture.kick_off and fixture.status != "FINISHED"
 
 
 class FootballDataApiClient(object):
 
-    def __init__(self, api_key, soccer_season_id):
+    def __init__(self, api_key, soccer_season_id, snapshot_store=None,
+                 timeout=(3.05, 10), pool_size=10, rate_limiter=None,
+                 max_retries=3, max_wait=None):
         self.base_endpoint = "http://api.football-data.org/v1"
         self.soccer_season_id = soccer_season_id
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        # Seconds a call may spend waiting on the rate limit, outside of
+        # background refreshes. None waits as long as the API asks.
+        self.max_wait = max_wait
         self.requests = requests.Session()
         self.requests.headers.update({"X-Auth-Token": api_key})
+        self.requests.mount(
+            "http://", HTTPAdapter(pool_maxsize=pool_size)
+        )
+        self.snapshot_store = snapshot_store
         self._all_teams = None
         self._all_fixtures = None
+        self._fixture_index = None
+        self._fixture_index_source = None
+        self.fixture_index_version = 0
 
-    def get_all_teams(self):
-        if self._all_teams is None:
-            response = self.requests.get(
-                "{0}/soccerseasons/{1}/teams".format(
-                    self.base_endpoint, self.soccer_season_id
+    @classmethod
+    def from_config(cls, config, soccer_season_id=424, max_wait=None):
+        """Build a client from the [football_data] section, with the shared
+        snapshot store and rate limiter when they are configured.
+        """
+        snapshot_store = None
+        if (
+            config.has_option("football_data", "snapshot_path") and
+            config.get("football_data", "snapshot_path")
+        ):
+            snapshot_store = FixtureSnapshotStore(
+                config.get("football_data", "snapshot_path"),
+                config.getint("football_data", "max_staleness")
+            )
+        rate_limiter = None
+        if (
+            config.has_option("football_data", "rate_limit_path") and
+            config.get("football_data", "rate_limit_path")
+        ):
+            rate_limiter = RateLimiter(
+                config.get("football_data", "rate_limit_path"),
+                config.getint("football_data", "rate_limit_per_minute")
+            )
+        return cls(
+            config.get("football_data", "api_key"), soccer_season_id,
+            snapshot_store, rate_limiter=rate_limiter, max_wait=max_wait
+        )
+
+    def get(self, path, headers=None, background=False):
+        """GET ``path``, waiting for the rate limit and retrying while the
+        API is over its quota. Outside of ``background`` calls, gives up
+        once that would take more than max_wait seconds in all: it raises
+        RateLimitExceeded rather than wait for a token, and returns the
+        429 or 503 response rather than back off.
+        """
+        url = "{0}/soccerseasons/{1}/{2}".format(
+            self.base_endpoint, self.soccer_season_id, path
+        )
+        deadline = None
+        if self.max_wait is not None and not background:
+            deadline = time.time() + self.max_wait
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None and not self.rate_limiter.acquire(
+                None if deadline is None else max(0, deadline - time.time())
+            ):
+                raise RateLimitExceeded(
+                    "Rate limited for longer than {0}s".format(self.max_wait)
                 )
+            response = self.requests.get(
+                url, headers=headers, timeout=self.timeout
             )
+            available = response.headers.get("X-Requests-Available")
+            reset_in = response.headers.get("X-RequestCounter-Reset")
+            reset_in = int(reset_in) if reset_in is not None else None
+            if self.rate_limiter is not None:
+                self.rate_limiter.update_from_api(
+                    int(available) if available is not None else None,
+                    reset_in
+                )
+            if (
+                response.status_code not in (429, 503) or
+                attempt == self.max_retries
+            ):
+                return response
+            # Back off until the quota resets, or exponentially if the API
+            # didn't say when that is
+            delay = reset_in if reset_in is not None else 2 ** attempt
+            if deadline is not None and time.time() + delay > deadline:
+                return response
+            time.sleep(delay)
+        return response
+
+    def prefetch(self):
+        """Fetch teams and fixtures concurrently."""
+        pool = ThreadPool(2)
+        try:
+            teams = pool.apply_async(self.get_all_teams)
+            fixtures = pool.apply_async(self.get_all_fixtures)
+            return teams.get(), fixtures.get()
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_all_teams(self):
+        if self._all_teams is None:
+            response = self.get("teams")
             response.raise_for_status()
             data = response.json()
             self._all_teams = [
@@ -25,31 +379,56 @@ class FootballDataApiClient(object):
             ]
         return self._all_teams
 
+    def fetch_fixtures_snapshot(self, current=None, background=False):
+        headers = {}
+        if current is not None:
+            if current.get("etag"):
+                headers["If-None-Match"] = current["etag"]
+            if current.get("last_modified"):
+                headers["If-Modified-Since"] = current["last_modified"]
+        response = self.get("fixtures", headers=headers, background=background)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        return {
+            "fixtures": response.json()["fixtures"],
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": time.time()
+        }
+
     def get_all_fixtures(self):
-        if self._all_fixtures is None:
-            response = self.requests.get(
-                "{0}/soccerseasons/{1}/fixtures".format(
-                    self.base_endpoint, self.soccer_season_id
-                )
+        if self.snapshot_store is None:
+            if self._all_fixtures is None:
+                snapshot = self.fetch_fixtures_snapshot()
+                self._all_fixtures = snapshot["fixtures"]
+            return self._all_fixtures
+
+        snapshot = self.snapshot_store.read()
+        if snapshot is None:
+            # Nothing on this host yet, so the very first request has to wait
+            self.snapshot_store.refresh(self.fetch_fixtures_snapshot)
+            snapshot = self.snapshot_store.read()
+        elif self.snapshot_store.is_stale(snapshot):
+            self.snapshot_store.refresh_in_background(
+                lambda current: self.fetch_fixtures_snapshot(current, True)
             )
-            response.raise_for_status()
-            self._all_fixtures = response.json()["fixtures"]
+        if snapshot is None:
+            # Another process held the refresh lock, fetch our own copy
+            snapshot = self.fetch_fixtures_snapshot()
+        self._all_fixtures = snapshot["fixtures"]
         return self._all_fixtures
 
     def get_results(self):
-        response = self.requests.get(
-            "{0}/soccerseasons/{1}/fixtures".format(
-                self.base_endpoint, self.soccer_season_id
-            )
-        )
-        response.raise_for_status()
+        # Derived from the same fixtures document as get_all_fixtures so a
+        # client never downloads it twice. Keyed like FixtureIndex.
         results = {}
-        for fixture in response.json()["fixtures"]:
+        for fixture in self.get_all_fixtures():
             if (
                 fixture["result"]["goalsHomeTeam"] is not None and
                 fixture["result"]["goalsAwayTeam"] is not None
             ):
-                game = "{}_{}_{}".format(
+                key = (
                     fixture["matchday"],
                     fixture["homeTeamName"],
                     fixture["awayTeamName"]
@@ -64,36 +443,35 @@ class FootballDataApiClient(object):
                         "home_score": fixture["result"]["goalsHomeTeam"],
                         "away_score": fixture["result"]["goalsAwayTeam"]
                     }
-                results[game] = score
+                results[key] = score
         return results
 
-    def check_predictions_validity(self, predictions):
+    def get_fixture_index(self):
         fixtures = self.get_all_fixtures()
+        if self._fixture_index_source is not fixtures:
+            self._fixture_index = FixtureIndex(fixtures)
+            self._fixture_index_source = fixtures
+            self.fixture_index_version += 1
+        return self._fixture_index
 
-        def find_fixture(matchday, home_team, away_team):
-            games = [
-                fixture for fixture in fixtures
-                if fixture["matchday"] == matchday and
-                fixture["homeTeamName"] == home_team and
-                fixture["awayTeamName"] == away_team
-            ]
-            if len(games) != 1:
+    def check_predictions_validity(self, predictions, current_time=None,
+                                   fixture_index=None):
+        if current_time is None:
+            current_time = datetime.now(tzutc())
+        if fixture_index is None:
+            fixture_index = self.get_fixture_index()
+
+        for prediction in predictions:
+            fixture = fixture_index.get_by_id(prediction["fixture_id"])
+            if fixture is None:
                 raise Exception(
                     "Looks like you tried to predict the score for a game "
                     "that doesn't exist!"
                 )
-            return games[0]
-
-        for prediction in predictions:
-            fixture = find_fixture(
-                prediction["matchday"],
-                prediction["home_team"],
-                prediction["away_team"]
-            )
-            if fixture["status"] == "FINISHED":
+            if not fixture_index.is_open(fixture, current_time):
                 raise Exception(
                     "You can't set a prediction for a game that has already "
-                    "happened!"
+                    "kicked off!"
                 )
 
         return True
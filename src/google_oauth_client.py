@@ -1,19 +1,97 @@
+import time
+import hashlib
+import threading
+
+from collections import OrderedDict
+
 import requests
+from requests.adapters import HTTPAdapter
+
+
+class TokenValidationCache(object):
+
+    def __init__(self, max_size=1024, negative_ttl=60, default_ttl=300):
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_digest(access_token):
+        return hashlib.sha256(access_token.encode("utf-8")).hexdigest()
+
+    def get(self, access_token):
+        digest = self.get_digest(access_token)
+        with self._lock:
+            entry = self._entries.pop(digest, None)
+            if entry is None:
+                return None
+            is_valid, expires_at = entry
+            if expires_at <= time.time():
+                return None
+            # Re-insert to mark as most recently used
+            self._entries[digest] = entry
+            return is_valid
+
+    def set(self, access_token, is_valid, expires_in=None):
+        if is_valid:
+            ttl = self.default_ttl if expires_in is None else expires_in
+        else:
+            ttl = self.negative_ttl
+        digest = self.get_digest(access_token)
+        with self._lock:
+            self._entries.pop(digest, None)
+            self._entries[digest] = (is_valid, time.time() + ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_validation_cache = TokenValidationCache()
 
 
 class GoogleOauth2Client(object):
 
-    def __init__(self):
-        self.base_endpoint = "https://www.googleapis.com/oauth2/v3"
+    def __init__(self, base_endpoint="https://www.googleapis.com/oauth2/v3",
+                 cache=token_validation_cache, timeout=(3.05, 5),
+                 pool_size=10):
+        self.base_endpoint = base_endpoint
+        self.cache = cache
+        self.timeout = timeout
+        self.requests = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.requests.mount("http://", adapter)
+        self.requests.mount("https://", adapter)
 
     def is_access_token_valid(self, access_token):
-        response = requests.get(
-            "{0}/tokeninfo?access_token={1}".format(
-                self.base_endpoint, access_token
-            )
-        )
+        if not access_token:
+            return False
+        is_valid = self.cache.get(access_token)
+        if is_valid is not None:
+            return is_valid
         try:
-            response.raise_for_status()
-            return True
-        except:
+            is_valid, expires_in = self.get_token_info(access_token)
+        except requests.RequestException:
+            # Don't cache transient failures talking to Google
             return False
+        self.cache.set(access_token, is_valid, expires_in)
+        return is_valid
+
+    def get_token_info(self, access_token):
+        response = self.requests.get(
+            "{0}/tokeninfo".format(self.base_endpoint),
+            params={"access_token": access_token},
+            timeout=self.timeout
+        )
+        if response.status_code == 400:
+            return False, None
+        response.raise_for_status()
+        try:
+            expires_in = int(response.json()["expires_in"])
+        except (ValueError, KeyError, TypeError):
+            expires_in = None
+        return True, expires_in
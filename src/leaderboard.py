@@ -0,0 +1,48 @@
+import bisect
+
+
+class Leaderboard(object):
+    """Immutable snapshot of the users ordered by points.
+
+    Ranks use standard competition ranking, so tied users share a position
+    and the next position is skipped ("1, 2, 2, 4").
+    """
+
+    def __init__(self, rows):
+        # rows: iterable of (user id, name, points), ordered by points desc
+        self.rows = []
+        self._negated_points = []
+        self._points_by_user = {}
+        rank = 0
+        previous_points = None
+        for position, (user_id, name, points) in enumerate(rows, 1):
+            if points != previous_points:
+                rank = position
+                previous_points = points
+            self.rows.append({
+                "rank": rank,
+                "id": user_id,
+                "name": name,
+                "points": points
+            })
+            self._negated_points.append(-points)
+            self._points_by_user[user_id] = points
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_rank_for_points(self, points):
+        return bisect.bisect_left(self._negated_points, -points) + 1
+
+    def get_rank(self, user_id):
+        points = self._points_by_user.get(user_id)
+        if points is None:
+            return None
+        return self.get_rank_for_points(points)
+
+    def get_page_count(self, per_page):
+        return max(1, (len(self.rows) + per_page - 1) // per_page)
+
+    def get_page(self, page, per_page):
+        start = (page - 1) * per_page
+        return self.rows[start:start + per_page]
@@ -0,0 +1,269 @@
+"""Push leaderboard and result changes to browsers as server-sent events.
+
+Each worker process runs one poller, which checks the version counters
+the pages already read and publishes what changed. Subscribers only wait
+for the next change and send their browser the part of it they show.
+Their stream is generated after the request has released its database
+session, so an idle subscriber costs a socket and, under gevent workers,
+a greenlet, but no database connection.
+"""
+
+import json
+import time
+import hashlib
+import threading
+
+from collections import deque, namedtuple
+
+from gevent import monkey
+from gevent.event import Event as GeventEvent
+
+import metrics
+
+from utils import get_results, get_results_version, \
+    get_leaderboard_version, get_predictions_leaderboard, \
+    get_points_for_results
+
+# Seconds between polls, on top of VERSIONS_CHECK_INTERVAL
+POLL_INTERVAL = 5
+# Comment sent on idle streams so that nginx and the ELB keep them open
+HEARTBEAT_INTERVAL = 15
+# Streams are closed after this long so that browsers reconnect, spreading
+# them over new workers and letting old ones be recycled
+STREAM_MAX_AGE = 600
+# Milliseconds browsers wait before reconnecting
+RECONNECT_DELAY = 5000
+# Diffs kept for subscribers that were still writing when newer ones came
+BACKLOG_SIZE = 16
+
+# A published change. ``text`` is the event as sent to every subscriber, if
+# any, ``results`` the new results to score each subscriber's predictions
+# against and ``leaderboard`` whether the leaderboard changed, in which case
+# each subscriber sends its own page of the latest one.
+Message = namedtuple(
+    "Message", ["sequence", "state", "text", "results", "leaderboard"]
+)
+
+
+def format_event(name, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append("id: {0}".format(event_id))
+    lines.append("event: {0}".format(name))
+    lines.append("data: {0}".format(json.dumps(data, separators=(",", ":"))))
+    return "\n".join(lines) + "\n\n"
+
+
+def can_stream(environ):
+    """Whether the server can hold a connection open per subscriber, as
+    gevent workers and the threaded development server can. A sync worker
+    would be tied up by a single subscriber.
+    """
+    return bool(environ.get("wsgi.multithread")) or \
+        monkey.is_module_patched("socket")
+
+
+def make_event():
+    # Under gevent, greenlets waiting on a threading.Event would poll it
+    if monkey.is_module_patched("threading"):
+        return GeventEvent()
+    return threading.Event()
+
+
+def get_state(results_version, leaderboard_version):
+    """The id of the events published for this version of the results and
+    the leaderboard. It only depends on the database, so a browser that
+    reconnects to another worker can tell whether it missed anything.
+    """
+    state = "{0}:{1}:{2}".format(results_version, *leaderboard_version)
+    return hashlib.sha1(state.encode("utf-8")).hexdigest()[:16]
+
+
+def diff_results(previous, results):
+    return {
+        fixture_id: score for fixture_id, score in results.items()
+        if previous.get(fixture_id) != score
+    }
+
+
+def get_page_standings(leaderboard, page, per_page, user_id):
+    """The rows of a subscriber's leaderboard page and their own rank."""
+    return {
+        "users": [
+            [row["id"], row["name"], row["rank"], row["points"]]
+            for row in leaderboard.get_page(page, per_page)
+        ],
+        "rank": leaderboard.get_rank(user_id)
+    }
+
+
+class LiveUpdates(object):
+    """Publishes the changes to the results and the leaderboard of ``app``
+    to the subscribers of this process.
+
+    Events:
+    - state: sent on connecting, with the id of what the page can show
+    - results: {"results": [{"fixture_id", "result"}]} for new or changed
+      results
+    - points: {"points": {fixture_id: {"result", "points"}}} for the
+      subscriber's own predictions on those results
+    - leaderboard: {"users": [[user id, name, rank, points]], "rank"} with
+      the rows of the subscriber's page and their own rank, when either
+      changed
+    - reset: the browser missed changes and should reload the page
+    """
+
+    def __init__(self, app, poll_interval=POLL_INTERVAL,
+                 backlog_size=BACKLOG_SIZE):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.state = None
+        self._versions = None
+        self._results = None
+        # Only the latest, as subscribers only need their current page
+        self._leaderboard = None
+        self._messages = deque(maxlen=backlog_size)
+        self._sequence = 0
+        self._published = None
+        self._started = False
+        # Only held while copying messages, never across I/O, as it is
+        # created before gevent workers patch threading
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Poll once and start polling in the background, on the first
+        subscriber of this process. Needs an app context.
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            self._published = make_event()
+        try:
+            self.poll()
+        except Exception:
+            self._started = False
+            raise
+        poller = threading.Thread(target=self.run)
+        poller.daemon = True
+        poller.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self.app.app_context():
+                try:
+                    self.poll()
+                except Exception:
+                    self.app.logger.exception("Couldn't poll for updates")
+
+    def poll(self):
+        versions = (get_results_version(), get_leaderboard_version())
+        if versions == self._versions:
+            return
+        results = get_results()
+
+        messages = []
+        if self._versions is not None:
+            changed_results = diff_results(self._results, results)
+            if changed_results:
+                messages.append(("results", {"results": [
+                    {
+                        "fixture_id": fixture_id,
+                        "result": "{home_score} - {away_score}".format(
+                            **score
+                        )
+                    }
+                    for fixture_id, score in sorted(changed_results.items())
+                ]}, changed_results, None))
+            if versions[1] != self._versions[1]:
+                messages.append((None, None, None, True))
+
+        self._versions = versions
+        self._results = results
+        self.publish(
+            get_state(*versions), messages, get_predictions_leaderboard()
+        )
+
+    def publish(self, state, messages, leaderboard):
+        with self._lock:
+            for name, data, results, leaderboard_changed in messages:
+                self._sequence += 1
+                self._messages.append(Message(
+                    self._sequence, state,
+                    format_event(name, data, state) if name else None,
+                    results, leaderboard_changed
+                ))
+            self._leaderboard = leaderboard
+            self.state = state
+            published, self._published = self._published, make_event()
+        published.set()
+
+    def get_messages(self, sequence):
+        """Return the latest sequence number, the event set on the next
+        publication, the messages published after ``sequence`` and the
+        latest leaderboard.
+        """
+        with self._lock:
+            return self._sequence, self._published, [
+                message for message in self._messages
+                if message.sequence > sequence
+            ], self._leaderboard
+
+    def stream(self, last_event_id=None, predictions=None, user_id=None,
+               page=None, per_page=None,
+               heartbeat_interval=HEARTBEAT_INTERVAL,
+               max_age=STREAM_MAX_AGE):
+        """Generate the events of one subscriber. ``last_event_id`` is the
+        Last-Event-ID header of a reconnecting browser and ``predictions``,
+        keyed by fixture id, the subscriber's own predictions. Leaderboard
+        events are only sent for subscribers viewing a ``page`` of it.
+        """
+        with self._lock:
+            sequence = self._sequence
+            state = self.state
+        metrics.LIVE_UPDATE_SUBSCRIBERS.inc()
+        try:
+            yield "retry: {0}\n\n".format(RECONNECT_DELAY)
+            if last_event_id and state and last_event_id != state:
+                # Something changed while the browser was reconnecting
+                yield format_event("reset", {}, state)
+                return
+            yield format_event("state", {}, state)
+
+            deadline = time.time() + max_age
+            standings = None
+            while True:
+                latest, published, messages, leaderboard = \
+                    self.get_messages(sequence)
+                if latest - sequence > len(messages):
+                    # Fell behind by more than the backlog
+                    yield format_event("reset", {}, self.state)
+                    return
+                for message in messages:
+                    if message.text:
+                        yield message.text
+                    if predictions and message.results:
+                        points = get_points_for_results(
+                            predictions, message.results
+                        )
+                        if points:
+                            yield format_event("points", {"points": points})
+                if page and any(message.leaderboard for message in messages):
+                    new_standings = get_page_standings(
+                        leaderboard, page, per_page, user_id
+                    )
+                    if new_standings != standings:
+                        standings = new_standings
+                        yield format_event(
+                            "leaderboard", standings, messages[-1].state
+                        )
+                sequence = latest
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                if not published.wait(min(heartbeat_interval, remaining)):
+                    yield ": keepalive\n\n"
+        finally:
+            metrics.LIVE_UPDATE_SUBSCRIBERS.dec()
@@ -0,0 +1,119 @@
+import os
+import time
+
+import requests
+from flask import g, request, has_request_context
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, \
+    REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REQUEST_LATENCY = Histogram(
+    "euro2016_request_latency_seconds",
+    "Time spent handling a request",
+    ["route", "method", "status"]
+)
+SQL_STATEMENTS = Counter(
+    "euro2016_sql_statements_total",
+    "SQL statements executed while handling a request",
+    ["route"]
+)
+SQL_TIME = Counter(
+    "euro2016_sql_seconds_total",
+    "Time spent in SQL statements while handling a request",
+    ["route"]
+)
+OUTBOUND_LATENCY = Histogram(
+    "euro2016_outbound_request_latency_seconds",
+    "Time spent waiting on HTTP calls to upstream APIs",
+    ["client", "status"]
+)
+OUTBOUND_ERRORS = Counter(
+    "euro2016_outbound_request_errors_total",
+    "HTTP calls to upstream APIs that failed without a response",
+    ["client", "error"]
+)
+LIVE_UPDATE_SUBSCRIBERS = Gauge(
+    "euro2016_live_update_subscribers",
+    "Browsers currently subscribed to live updates",
+    multiprocess_mode="livesum"
+)
+
+
+def get_route():
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if has_request_context():
+        g.sql_statement_started_at = time.time()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    # Only count statements issued by requests that went through
+    # before_request
+    if has_request_context() and "sql_statements" in g:
+        g.sql_statements += 1
+        g.sql_time += time.time() - g.sql_statement_started_at
+
+
+def before_request():
+    g.request_started_at = time.time()
+    g.sql_statements = 0
+    g.sql_time = 0
+
+
+def after_request(response):
+    route = get_route()
+    REQUEST_LATENCY.labels(route, request.method, response.status_code) \
+        .observe(time.time() - g.request_started_at)
+    if g.get("sql_statements"):
+        SQL_STATEMENTS.labels(route).inc(g.sql_statements)
+        SQL_TIME.labels(route).inc(g.sql_time)
+    return response
+
+
+def instrument_session(session, client):
+    """Record the latency of the calls ``session`` makes to ``client``, and
+    the calls that got no response, e.g. timeouts and connection errors.
+    """
+    send = session.send
+
+    def instrumented_send(request, **kwargs):
+        try:
+            response = send(request, **kwargs)
+        except requests.RequestException as e:
+            OUTBOUND_ERRORS.labels(client, type(e).__name__).inc()
+            raise
+        OUTBOUND_LATENCY.labels(client, response.status_code).observe(
+            response.elapsed.total_seconds()
+        )
+        return response
+
+    session.send = instrumented_send
+
+
+def init_app(app):
+    # The listeners are global, so only add them for the first app
+    if not event.contains(
+        Engine, "before_cursor_execute", before_cursor_execute
+    ):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+    app.before_request(before_request)
+    app.after_request(after_request)
+
+
+def generate_metrics():
+    # Under gunicorn each worker writes its samples to files in
+    # PROMETHEUS_MULTIPROC_DIR, which are merged here
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,309 @@
+"""Bring existing databases up to date with models.py.
+
+db.create_all() only creates missing tables, so changes to tables that
+already exist are applied here, in order. The number of migrations a
+database has had is kept in the versions table under "schema". MySQL
+commits DDL as it goes, so every migration checks what is already there
+and can be run again if it was interrupted.
+"""
+
+import logging
+
+from sqlalchemy import inspect, select, text, MetaData, Table, Column, \
+    Index, Integer, String, ForeignKey
+
+from models import db, User, Version
+
+SCHEMA_VERSION_NAME = "schema"
+
+logger = logging.getLogger(__name__)
+
+
+def has_table(connection, table_name):
+    return connection.dialect.has_table(connection, table_name)
+
+
+def get_column_names(connection, table_name):
+    return {
+        column["name"]
+        for column in inspect(connection).get_columns(table_name)
+    }
+
+
+def get_index_names(connection, table_name):
+    return {
+        index["name"] for index in inspect(connection).get_indexes(table_name)
+    }
+
+
+def create_index(connection, table_name, name, columns, unique=False):
+    if name in get_index_names(connection, table_name):
+        return
+    logger.info("Creating index %s on %s", name, table_name)
+    connection.execute(text("CREATE {0}INDEX {1} ON {2} ({3})".format(
+        "UNIQUE " if unique else "", name, table_name, columns
+    )))
+
+
+def add_column(connection, table_name, name, definition):
+    """Add a column unless the table already has it, or doesn't exist yet
+    and will be created with it. Returns whether the column was added.
+    """
+    if (
+        not has_table(connection, table_name) or
+        name in get_column_names(connection, table_name)
+    ):
+        return False
+    logger.info("Adding column %s to %s", name, table_name)
+    connection.execute(text("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+        table_name, name, definition
+    )))
+    return True
+
+
+def replace_table(connection, new_table, copy_sql):
+    """Replace a table by ``new_table``, named like it plus "_new", copying
+    its rows over with ``copy_sql``. This works the same in SQLite, which
+    can't alter columns, and carries on if it was interrupted before the
+    rename.
+    """
+    name = new_table.name[:-len("_new")]
+    if has_table(connection, name):
+        logger.info("Rebuilding table %s", name)
+        new_table.drop(connection, checkfirst=True)
+        new_table.create(connection)
+        connection.execute(text(copy_sql))
+        connection.execute(text("DROP TABLE {0}".format(name)))
+    connection.execute(text("ALTER TABLE {0} RENAME TO {1}".format(
+        new_table.name, name
+    )))
+
+
+# Migrations describe the tables as they leave them rather than importing
+# the models, which keep changing after the migration was written.
+
+def reset_points(connection):
+    """Zero every prediction's and user's points and mark every result as
+    not scored, so that the next update rescores them all from scratch.
+    It adds each prediction's points to its user's total, which would
+    otherwise count them twice.
+    """
+    logger.warning("Points are reset until the next update rescores them")
+    connection.execute(text("UPDATE predictions SET points = 0"))
+    connection.execute(text("UPDATE users SET points = 0"))
+    if (
+        has_table(connection, "results") and
+        "scored" in get_column_names(connection, "results")
+    ):
+        connection.execute(text("UPDATE results SET scored = 0"))
+
+
+def add_prediction_points(connection):
+    if add_column(
+        connection, "predictions", "points", "INTEGER NOT NULL DEFAULT 0"
+    ):
+        reset_points(connection)
+
+
+def add_team_allocation_counts(connection):
+    if add_column(
+        connection, "teams", "allocation_count", "INTEGER NOT NULL DEFAULT 0"
+    ):
+        connection.execute(text(
+            "UPDATE teams SET allocation_count = ("
+            "SELECT COUNT(*) FROM users "
+            "WHERE users.allocated_team_id = teams.id)"
+        ))
+
+
+def add_user_predictions_versions(connection):
+    add_column(
+        connection, "users", "predictions_version",
+        "INTEGER NOT NULL DEFAULT 0"
+    )
+
+
+def add_hot_query_indexes(connection):
+    create_index(
+        connection, "users", "ix_users_points_name", "points DESC, name"
+    )
+    if "home_team" not in get_column_names(connection, "predictions"):
+        # Already keyed by fixture id, with that migration's indexes
+        return
+
+    # Keep the latest of any duplicate predictions so that the unique index
+    # can be built. The derived table is needed for MySQL, which can't
+    # select from the table it deletes from.
+    deleted = connection.execute(text(
+        "DELETE FROM predictions WHERE id NOT IN ("
+        "SELECT id FROM ("
+        "SELECT MAX(id) AS id FROM predictions "
+        "GROUP BY user_id, matchday, home_team, away_team"
+        ") AS latest)"
+    )).rowcount
+    if deleted:
+        # Their points are still in their users' totals
+        logger.warning("Deleted %d duplicate predictions", deleted)
+        reset_points(connection)
+    create_index(
+        connection, "predictions", "uq_predictions_user_game",
+        "user_id, matchday, home_team, away_team", unique=True
+    )
+    create_index(
+        connection, "predictions", "ix_predictions_game",
+        "matchday, home_team, away_team, user_id"
+    )
+    # MySQL made an index named after the column for the user_id foreign
+    # key, which the unique index now covers
+    if (
+        connection.dialect.name == "mysql" and
+        "user_id" in get_index_names(connection, "predictions")
+    ):
+        connection.execute(text("DROP INDEX user_id ON predictions"))
+
+
+def reference_fixtures_by_id(connection):
+    metadata = MetaData()
+    Table("users", metadata, Column("id", Integer, primary_key=True))
+    fixtures = Table(
+        "fixtures", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("matchday", Integer, nullable=False),
+        Column("home_team", String(100), nullable=False),
+        Column("away_team", String(100), nullable=False),
+        Index(
+            "uq_fixtures_game", "matchday", "home_team", "away_team",
+            unique=True
+        )
+    )
+    predictions = Table(
+        "predictions_new", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("home_score", Integer, nullable=False),
+        Column("away_score", Integer, nullable=False),
+        Column("points", Integer, nullable=False, server_default="0"),
+        Column("user_id", Integer, ForeignKey("users.id")),
+        Column(
+            "fixture_id", Integer, ForeignKey("fixtures.id"), nullable=False
+        ),
+        Index(
+            "uq_predictions_user_fixture", "user_id", "fixture_id",
+            unique=True
+        ),
+        Index("ix_predictions_fixture", "fixture_id", "user_id")
+    )
+    results = Table(
+        "results_new", metadata,
+        Column(
+            "fixture_id", Integer, ForeignKey("fixtures.id"),
+            primary_key=True, autoincrement=False
+        ),
+        Column("home_score", Integer, nullable=False),
+        Column("away_score", Integer, nullable=False)
+    )
+    fixtures.create(connection, checkfirst=True)
+
+    # Tables still keyed by matchday and team names
+    string_keyed = [
+        name for name in ("predictions", "results")
+        if has_table(connection, name) and
+        "home_team" in get_column_names(connection, name)
+    ]
+    if string_keyed:
+        # Every game predicted or with a result gets a fixture, the feed
+        # adds any others the next time the fixtures are synced
+        connection.execute(text(
+            "INSERT INTO fixtures (matchday, home_team, away_team) "
+            "SELECT matchday, home_team, away_team FROM ({0}) AS games "
+            "WHERE NOT EXISTS (SELECT 1 FROM fixtures "
+            "WHERE fixtures.matchday = games.matchday "
+            "AND fixtures.home_team = games.home_team "
+            "AND fixtures.away_team = games.away_team)".format(" UNION ".join(
+                "SELECT matchday, home_team, away_team FROM {0}".format(name)
+                for name in string_keyed
+            ))
+        ))
+
+    join = (
+        "JOIN fixtures f ON f.matchday = old.matchday "
+        "AND f.home_team = old.home_team AND f.away_team = old.away_team"
+    )
+    for table, copy_sql in (
+        (predictions, "INSERT INTO predictions_new "
+         "(id, user_id, fixture_id, home_score, away_score, points) "
+         "SELECT old.id, old.user_id, f.id, old.home_score, "
+         "old.away_score, old.points FROM predictions old " + join),
+        (results, "INSERT INTO results_new "
+         "(fixture_id, home_score, away_score) "
+         "SELECT f.id, old.home_score, old.away_score FROM results old " +
+         join)
+    ):
+        name = table.name[:-len("_new")]
+        if name in string_keyed or (
+            not has_table(connection, name) and
+            has_table(connection, table.name)
+        ):
+            replace_table(connection, table, copy_sql)
+
+
+def add_results_scored(connection):
+    # Existing results are scored once more by the next update, which only
+    # changes points that are out of date
+    add_column(connection, "results", "scored", "BOOLEAN NOT NULL DEFAULT 0")
+
+
+MIGRATIONS = [
+    ("Add points to predictions", add_prediction_points),
+    ("Count the users allocated to each team", add_team_allocation_counts),
+    ("Add a predictions version to users", add_user_predictions_versions),
+    ("Add indexes for the prediction and leaderboard queries",
+     add_hot_query_indexes),
+    ("Reference fixtures by id from predictions and results",
+     reference_fixtures_by_id),
+    ("Mark results whose predictions have been scored", add_results_scored)
+]
+
+
+def get_schema_version(connection):
+    return connection.execute(
+        select([Version.value]).where(Version.name == SCHEMA_VERSION_NAME)
+    ).scalar()
+
+
+def set_schema_version(connection, version, insert=False):
+    versions = Version.__table__
+    if insert:
+        statement = versions.insert().values(name=SCHEMA_VERSION_NAME)
+    else:
+        statement = versions.update().where(
+            versions.c.name == SCHEMA_VERSION_NAME
+        )
+    connection.execute(statement.values(value=version))
+
+
+def upgrade_schema():
+    """Apply the migrations this database hasn't had yet and create missing
+    tables. A new database gets the current schema from create_all() and
+    is marked as fully migrated. Returns the number of migrations applied.
+    """
+    with db.engine.connect() as connection:
+        if not has_table(connection, User.__tablename__):
+            db.create_all()
+            set_schema_version(connection, len(MIGRATIONS), insert=True)
+            return 0
+
+        Version.__table__.create(connection, checkfirst=True)
+        version = get_schema_version(connection)
+        if version is None:
+            version = 0
+            set_schema_version(connection, version, insert=True)
+        for number, (description, migrate) in enumerate(
+            MIGRATIONS[version:], version + 1
+        ):
+            logger.info("Applying migration %d: %s", number, description)
+            with connection.begin():
+                migrate(connection)
+                set_schema_version(connection, number)
+    # Only now, so tables being rebuilt aren't created empty
+    db.create_all()
+    return len(MIGRATIONS) - version
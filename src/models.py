@@ -1,9 +1,103 @@
+import time
+import random
 import datetime
+import functools
 import urllib
 
-from flask_sqlalchemy import SQLAlchemy
+from collections import namedtuple
+from contextlib import contextmanager
 
-db = SQLAlchemy()
+from flask import current_app, has_request_context, session as user_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+
+# Flask session key holding the time until which the user's reads go to
+# the primary, so that they see their own writes despite replication lag
+PRIMARY_UNTIL_KEY = "primary_until"
+
+
+def has_written_recently():
+    return (
+        has_request_context() and
+        user_session.get(PRIMARY_UNTIL_KEY, 0) > time.time()
+    )
+
+
+class RoutingSession(SignallingSession):
+    """Sends the queries made in db.replica() blocks to one of the read
+    replicas in the app's REPLICA_BINDS, if any, and everything else to the
+    primary. A session sticks to one replica so that a request sees a
+    consistent view.
+    """
+
+    def __init__(self, db, **options):
+        SignallingSession.__init__(self, db, **options)
+        self._db = db
+        self.use_replica = False
+        self._replica = None
+
+    def get_replica(self):
+        if self._replica is None:
+            binds = self.app.config.get("REPLICA_BINDS")
+            if not binds:
+                return None
+            self._replica = self._db.get_engine(
+                self.app, random.choice(binds)
+            )
+        return self._replica
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.use_replica and not self._flushing:
+            replica = self.get_replica()
+            if replica is not None:
+                return replica
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def after_commit(session):
+    # The web app only commits after writing, so keep the user who made
+    # the request on the primary until the replicas have caught up
+    if has_request_context():
+        user_session[PRIMARY_UNTIL_KEY] = time.time() + \
+            current_app.config.get("READ_YOUR_WRITES_SECONDS", 0)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    @contextmanager
+    def replica(self):
+        """Read from a replica inside this block, unless the current user
+        wrote recently.
+        """
+        session = self.session()
+        previous = session.use_replica
+        session.use_replica = not has_written_recently()
+        try:
+            yield
+        finally:
+            session.use_replica = previous
+
+    def read_only(self, func):
+        """Run ``func`` in a db.replica() block."""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.replica():
+                return func(*args, **kwargs)
+        return wrapper
+
+
+db = RoutingSQLAlchemy()
+
+# Read-only views handed to templates instead of ORM objects
+UserProfile = namedtuple("UserProfile", [
+    "id", "name", "email", "joined_date", "allocated_team", "predictions",
+    "points", "predictions_version"
+])
+TeamProfile = namedtuple("TeamProfile", ["name", "crest_url"])
 
 
 class User(db.Model):
@@ -15,25 +109,38 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow())
     allocated_team_id = db.Column(db.Integer, db.ForeignKey("teams.id"))
     points = db.Column(db.Integer, nullable=False)
+    predictions_version = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
 
     allocated_team = db.relationship("Team")
     predictions = db.relationship(
         "Prediction", cascade="delete, delete-orphan"
     )
 
-    def to_json(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "email": self.email,
-            "joined_date": self.created_at,
-            "allocated_team": self.allocated_team.to_json(),
-            "predictions": {
-                prediction.get_key(): prediction.get_value()
-                for prediction in self.predictions
-            },
-            "points": self.points
-        }
+    def to_profile(self, with_team=False, with_predictions=False):
+        return UserProfile(
+            id=self.id,
+            name=self.name,
+            email=self.email,
+            joined_date=self.created_at,
+            allocated_team=(
+                self.allocated_team.to_profile() if with_team else None
+            ),
+            predictions=(
+                {
+                    prediction.get_key(): prediction.get_value()
+                    for prediction in self.predictions
+                } if with_predictions else None
+            ),
+            points=self.points,
+            predictions_version=self.predictions_version
+        )
+
+
+# The leaderboard order. InnoDB and SQLite secondary indexes carry the
+# primary key, so this also covers the (id, name, points) leaderboard rows.
+db.Index("ix_users_points_name", User.points.desc(), User.name)
 
 
 class Team(db.Model):
@@ -42,33 +149,79 @@ class Team(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
     crest_url = db.Column(db.String(100), nullable=False)
+    allocation_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
 
     allocated_users = db.relationship("User", back_populates="allocated_team")
 
-    def to_json(self):
-        return {
-            "name": self.name,
-            "crest_url": urllib.quote_plus(self.crest_url, safe="/:")
+    def to_profile(self):
+        return TeamProfile(
+            name=self.name,
+            crest_url=urllib.quote_plus(self.crest_url, safe="/:")
+        )
+
+
+class Fixture(db.Model):
+    __tablename__ = "fixtures"
+
+    id = db.Column(db.Integer, primary_key=True)
+    matchday = db.Column(db.Integer, nullable=False)
+    home_team = db.Column(db.String(100), nullable=False)
+    away_team = db.Column(db.String(100), nullable=False)
+
+    def get_key(self):
+        return (self.matchday, self.home_team, self.away_team)
+
+    @classmethod
+    def sync(cls, session, keys):
+        """Return the ids of the fixtures with the given (matchday, home
+        team, away team) keys, adding the ones the table doesn't have yet.
+        New rows are flushed, committing is left to the caller.
+        """
+        ids = {
+            (matchday, home_team, away_team): fixture_id
+            for fixture_id, matchday, home_team, away_team in session.query(
+                cls.id, cls.matchday, cls.home_team, cls.away_team
+            )
         }
+        missing = set(keys) - set(ids)
+        if missing:
+            session.bulk_insert_mappings(cls, [
+                {"matchday": matchday, "home_team": home_team,
+                 "away_team": away_team}
+                for matchday, home_team, away_team in sorted(missing)
+            ])
+            session.flush()
+            return cls.sync(session, keys)
+        return ids
+
+
+db.Index(
+    "uq_fixtures_game", Fixture.matchday, Fixture.home_team,
+    Fixture.away_team, unique=True
+)
 
 
 class Prediction(db.Model):
     __tablename__ = "predictions"
 
     id = db.Column(db.Integer, primary_key=True)
-    matchday = db.Column(db.Integer, nullable=False, default=0)
-    home_team = db.Column(db.String(100), nullable=False)
     home_score = db.Column(db.Integer, nullable=False)
-    away_team = db.Column(db.String(100), nullable=False)
     away_score = db.Column(db.Integer, nullable=False)
+    points = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
 
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     user = db.relationship("User", back_populates="predictions")
+    fixture_id = db.Column(
+        db.Integer, db.ForeignKey("fixtures.id"), nullable=False
+    )
+    fixture = db.relationship("Fixture")
 
     def get_key(self):
-        return "{0}_{1}_{2}".format(
-            self.matchday, self.home_team, self.away_team
-        )
+        return self.fixture_id
 
     def get_value(self):
         return {
@@ -77,22 +230,56 @@ class Prediction(db.Model):
         }
 
 
+# One prediction per user and fixture. It also serves the per-user lookups
+# and the index MySQL needs for the user_id foreign key.
+db.Index(
+    "uq_predictions_user_fixture", Prediction.user_id, Prediction.fixture_id,
+    unique=True
+)
+# Finding who predicted a fixture when its result comes in
+db.Index(
+    "ix_predictions_fixture", Prediction.fixture_id, Prediction.user_id
+)
+
+
 class Result(db.Model):
     __tablename__ = "results"
 
-    matchday = db.Column(db.Integer, nullable=False, default=0)
-    home_team = db.Column(db.String(100), primary_key=True, nullable=False)
+    fixture_id = db.Column(
+        db.Integer, db.ForeignKey("fixtures.id"), primary_key=True,
+        autoincrement=False
+    )
     home_score = db.Column(db.Integer, nullable=False)
-    away_team = db.Column(db.String(100), primary_key=True, nullable=False)
     away_score = db.Column(db.Integer, nullable=False)
+    # Whether the predictions for this fixture have been scored against
+    # this score. Cleared whenever the score is written.
+    scored = db.Column(
+        db.Boolean, nullable=False, default=False, server_default="0"
+    )
+
+    fixture = db.relationship("Fixture")
 
     def get_key(self):
-        return "{0}_{1}_{2}".format(
-            self.matchday, self.home_team, self.away_team
-        )
+        return self.fixture_id
 
     def get_value(self):
         return {
             "home_score": self.home_score,
             "away_score": self.away_score
         }
+
+
+class Version(db.Model):
+    __tablename__ = "versions"
+
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def bump(cls, session, name):
+        """Increment the version ``name``, in the session's transaction."""
+        updated = session.query(cls).filter_by(name=name).update(
+            {cls.value: cls.value + 1}, synchronize_session=False
+        )
+        if not updated:
+            session.add(cls(name=name, value=1))
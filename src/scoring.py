@@ -0,0 +1,78 @@
+EXACT_SCORE_POINTS = 3
+CORRECT_OUTCOME_POINTS = 1
+# Below this many predictions converting lists to arrays costs more than
+# NumPy saves, so a page of predictions is scored in pure Python and the web
+# tier never imports NumPy
+NUMPY_MIN_BATCH = 500
+
+_numpy = {}
+
+
+def get_numpy():
+    """NumPy, imported on first use, or None when it isn't installed."""
+    if "module" not in _numpy:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy["module"] = numpy
+    return _numpy["module"]
+
+
+def _sign(value):
+    return (value > 0) - (value < 0)
+
+
+def score_predictions_python(predicted_home, predicted_away, actual_home,
+                             actual_away):
+    points = []
+    for ph, pa, ah, aa in zip(
+        predicted_home, predicted_away, actual_home, actual_away
+    ):
+        if ph == ah and pa == aa:
+            points.append(EXACT_SCORE_POINTS)
+        elif _sign(ph - pa) == _sign(ah - aa):
+            points.append(CORRECT_OUTCOME_POINTS)
+        else:
+            points.append(0)
+    return points
+
+
+def score_predictions_numpy(predicted_home, predicted_away, actual_home,
+                            actual_away):
+    numpy = get_numpy()
+    predicted_home = numpy.asarray(predicted_home, dtype=numpy.int32)
+    predicted_away = numpy.asarray(predicted_away, dtype=numpy.int32)
+    actual_home = numpy.asarray(actual_home, dtype=numpy.int32)
+    actual_away = numpy.asarray(actual_away, dtype=numpy.int32)
+    exact = (predicted_home == actual_home) & (predicted_away == actual_away)
+    outcome = (
+        numpy.sign(predicted_home - predicted_away) ==
+        numpy.sign(actual_home - actual_away)
+    )
+    return numpy.where(
+        exact, EXACT_SCORE_POINTS,
+        numpy.where(outcome, CORRECT_OUTCOME_POINTS, 0)
+    )
+
+
+def score_predictions(predicted_home, predicted_away, actual_home,
+                      actual_away):
+    """Score a batch of predictions against the actual results.
+
+    Takes four equal length sequences of goals and returns the points for
+    each prediction: 3 for the exact score, 1 for the right outcome, else 0.
+    NumPy arrays, and sequences of at least NUMPY_MIN_BATCH goals when NumPy
+    is installed, are scored with NumPy and return an array. Anything else
+    returns a list.
+    """
+    if (
+        not hasattr(predicted_home, "dtype") and
+        len(predicted_home) < NUMPY_MIN_BATCH or get_numpy() is None
+    ):
+        return score_predictions_python(
+            predicted_home, predicted_away, actual_home, actual_away
+        )
+    return score_predictions_numpy(
+        predicted_home, predicted_away, actual_home, actual_away
+    )
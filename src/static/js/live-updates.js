@@ -0,0 +1,68 @@
+// Applies the server-sent events of /updates to the leaderboard and the
+// predictions page, so that new results and points show without a reload
+$(function () {
+    var script = $("script[data-updates-url]");
+    if (!window.EventSource || !script.length) {
+        return;
+    }
+    var source = new EventSource(script.data("updates-url"));
+
+    function byFixture(selector, fixtureId) {
+        return $(selector + "[data-fixture-id='" + fixtureId + "']");
+    }
+
+    source.addEventListener("reset", function () {
+        // Changes were missed while disconnected
+        source.close();
+        window.location.reload();
+    });
+
+    source.addEventListener("results", function (event) {
+        $.each(JSON.parse(event.data).results, function (i, result) {
+            byFixture(".result", result.fixture_id).text(result.result);
+        });
+    });
+
+    source.addEventListener("points", function (event) {
+        $.each(JSON.parse(event.data).points, function (fixtureId, points) {
+            byFixture(".result", fixtureId).text(points.result);
+            byFixture(".points", fixtureId).text(points.points);
+        });
+    });
+
+    source.addEventListener("leaderboard", function (event) {
+        var leaderboard = $("#leaderboard");
+        if (!leaderboard.length) {
+            return;
+        }
+        var standings = JSON.parse(event.data);
+        if (standings.rank) {
+            $("#user-rank").text(standings.rank);
+        }
+
+        // Rebuild this page's rows, in order, from [user id, name, rank,
+        // points], reusing the rows of users already on it
+        var rows = leaderboard.find("tr[data-user-id]");
+        var template = rows.first();
+        if (!template.length) {
+            return;
+        }
+        var header = leaderboard.find("tr").first();
+        var previous = header;
+        $.each(standings.users, function (i, user) {
+            var row = rows.filter("[data-user-id='" + user[0] + "']");
+            if (!row.length) {
+                row = template.clone();
+                row.attr("data-user-id", user[0]);
+                var link = row.find(".name a");
+                link.attr("href", link.attr("href").replace(/\d+$/, user[0]));
+            }
+            row.find(".name a").text(user[1]);
+            row.find(".rank").text(user[2]);
+            row.find(".points").text(user[3]);
+            row.insertAfter(previous);
+            previous = row;
+        });
+        previous.nextAll("tr[data-user-id]").remove();
+    });
+});
@@ -1,15 +1,52 @@
 import pytz
+import time
 import random
 
 from datetime import datetime
 from collections import OrderedDict
 from ConfigParser import SafeConfigParser
 
-from sqlalchemy import desc
+from flask import Flask
+from sqlalchemy import desc, func
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.orm import joinedload, selectinload
 
 from google_oauth_client import GoogleOauth2Client
 
-from models import db, User, Prediction, Team, Result
+from leaderboard import Leaderboard
+from models import db, User, Prediction, Team, Result, Version, Fixture
+from scoring import score_predictions
+
+CONFIG_PATH = "./config/config.cfg"
+
+google_oauth2_client = GoogleOauth2Client()
+
+# How often, in seconds, to read the versions table. The update lambda
+# bumps "results" and "points" and add_user bumps "users".
+VERSIONS_CHECK_INTERVAL = 5
+
+# How often, in seconds, to look for the ids of fixtures that are in the
+# football-data feed but not yet in the fixtures table
+FIXTURE_IDS_CHECK_INTERVAL = 30
+
+# Loader options and profile contents for each way a page uses a user:
+# "basic" is a single row, "team" joins the allocated team in the same
+# query and "predictions" adds one select-in query for the predictions.
+PROFILE_LOADING_STRATEGIES = {
+    "basic": ((), False, False),
+    "team": ((joinedload(User.allocated_team),), True, False),
+    "predictions": (
+        (joinedload(User.allocated_team), selectinload(User.predictions)),
+        True,
+        True
+    )
+}
+
+_leaderboard_cache = {}
+_team_allocations_cache = {}
+_results_cache = {}
+_versions_cache = {}
+_fixture_ids_cache = {}
 
 
 def get_config(config_path):
@@ -18,12 +55,50 @@ def get_config(config_path):
     return config
 
 
-def is_user_logged_in(session):
-    google_oauth2_client = GoogleOauth2Client()
+def create_db_app(config, import_name=__name__):
+    """A Flask app with only the database bound, for scripts that need the
+    models and the helpers here but none of the web app.
+    """
+    replica_urls = []
+    if config.has_option("db", "replica_db_urls"):
+        replica_urls = [
+            url.strip()
+            for url in config.get("db", "replica_db_urls").split(",")
+            if url.strip()
+        ]
+    replica_binds = {
+        "replica_{0}".format(i): url for i, url in enumerate(replica_urls)
+    }
+    app = Flask(import_name)
+    app.config.update(
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SQLALCHEMY_DATABASE_URI=config.get("db", "sqlalchemy_db_url"),
+        SQLALCHEMY_BINDS=replica_binds,
+        REPLICA_BINDS=sorted(replica_binds),
+        READ_YOUR_WRITES_SECONDS=(
+            config.getint("db", "read_your_writes_seconds")
+            if config.has_option("db", "read_your_writes_seconds") else 0
+        )
+    )
+    db.init_app(app)
+    return app
+
+
+def load_user_profile(strategy="basic", **filters):
+    options, with_team, with_predictions = \
+        PROFILE_LOADING_STRATEGIES[strategy]
+    user = User.query.options(*options).filter_by(**filters).first()
+    if user is None:
+        return None
+    return user.to_profile(with_team, with_predictions)
+
+
+@db.read_only
+def is_user_logged_in(session, strategy="basic"):
     access_token = session.get("access_token")
     if not google_oauth2_client.is_access_token_valid(access_token):
         return False, None
-    user = User.query.filter_by(email=session["user"]["email"]).first()
+    user = load_user_profile(strategy, email=session["user"]["email"])
     if not user:
         return False, None
     return True, user
@@ -36,16 +111,38 @@ def is_valid_email_domain(domain_name, whitelisted_domains):
     return False
 
 
-def allocate_team():
-    teams = Team.query.all()
-    unallocated_teams = []
-    i = 0
-    while unallocated_teams == []:
-        unallocated_teams = [
-            team for team in teams if len(team.allocated_users) <= i
-        ]
-        i += 1
-    return random.choice(unallocated_teams)
+def allocate_team(attempts=5):
+    for _ in range(attempts):
+        # Lock the team rows so concurrent sign-ups queue up behind each
+        # other instead of both picking the same least allocated team
+        teams = db.session.query(
+            Team.id, Team.allocation_count
+        ).with_for_update().all()
+        least_allocated = min(count for _, count in teams)
+        team_id = random.choice([
+            team_id for team_id, count in teams if count == least_allocated
+        ])
+        # Only succeeds if nobody allocated this team since we read it, for
+        # databases that ignore FOR UPDATE
+        updated = Team.query.filter_by(
+            id=team_id, allocation_count=least_allocated
+        ).update(
+            {Team.allocation_count: Team.allocation_count + 1},
+            synchronize_session=False
+        )
+        if updated:
+            return Team.query.get(team_id)
+    raise Exception("Couldn't allocate a team, please try again!")
+
+
+def sync_team_allocation_counts():
+    allocated_users = db.session.query(func.count(User.id)).filter(
+        User.allocated_team_id == Team.id
+    ).as_scalar()
+    Team.query.update(
+        {Team.allocation_count: allocated_users}, synchronize_session=False
+    )
+    db.session.commit()
 
 
 def add_user(session, token, profile):
@@ -55,84 +152,257 @@ def add_user(session, token, profile):
         user = User(email=profile["email"], name=profile["name"], points=0)
         user.allocated_team = allocate_team()
         db.session.add(user)
+        Version.bump(db.session, "users")
         db.session.commit()
+        _versions_cache.clear()
     session["user"] = profile
     return user
 
 
-def get_user_information(user_id):
-    return User.query.filter_by(id=user_id).one()
+@db.read_only
+def get_user_information(user_id, strategy="predictions"):
+    user = load_user_profile(strategy, id=user_id)
+    if user is None:
+        raise Exception("User {0} doesn't exist!".format(user_id))
+    return user
 
 
-def get_user_count():
-    return User.query.count()
+def table_exists(table_name):
+    with db.engine.connect() as connection:
+        return db.engine.dialect.has_table(connection, table_name)
 
 
-def get_team_allocations():
-    all_teams = Team.query.all()
-    return {
-        team.name: ", ".join([user.name for user in team.allocated_users])
-        for team in all_teams
+@db.read_only
+def get_version(name):
+    if (
+        time.time() - _versions_cache.get("checked_at", 0) >=
+        VERSIONS_CHECK_INTERVAL
+    ):
+        try:
+            versions = dict(db.session.query(Version.name, Version.value))
+        except (OperationalError, ProgrammingError):
+            db.session.rollback()
+            if table_exists(Version.__tablename__):
+                raise
+            versions = {}
+        _versions_cache["versions"] = versions
+        _versions_cache["checked_at"] = time.time()
+    return _versions_cache["versions"].get(name, 0)
+
+
+def get_results_version():
+    return get_version("results")
+
+
+def get_leaderboard_version():
+    # Points only move when the update lambda rescores and users only join
+    # through add_user, so the leaderboard changes with these two counters
+    return get_version("points"), get_version("users")
+
+
+@db.read_only
+def get_results():
+    version = get_results_version()
+    if _results_cache.get("version") == version:
+        return _results_cache["results"]
+    try:
+        rows = db.session.query(
+            Result.fixture_id, Result.home_score, Result.away_score
+        ).all()
+    except (OperationalError, ProgrammingError):
+        # The results table is only created once the first update has run
+        db.session.rollback()
+        if table_exists(Result.__tablename__):
+            raise
+        rows = []
+    results = {
+        fixture_id: {
+            "home_score": home_score,
+            "away_score": away_score
+        }
+        for fixture_id, home_score, away_score in rows
     }
+    _results_cache["results"] = results
+    _results_cache["version"] = version
+    return results
+
+
+def get_fixture_index(football_api_client):
+    """The client's FixtureIndex with the ids of the fixtures table. Feed
+    fixtures the table doesn't have yet, until the update lambda or
+    create_db_tables.py adds them, keep an id of None.
+    """
+    fixture_index = football_api_client.get_fixture_index()
+    if not fixture_index.missing_ids:
+        return fixture_index
+    if (
+        time.time() - _fixture_ids_cache.get("checked_at", 0) >=
+        FIXTURE_IDS_CHECK_INTERVAL
+    ):
+        _fixture_ids_cache["ids"] = {
+            (matchday, home_team, away_team): fixture_id
+            for fixture_id, matchday, home_team, away_team in db.session.query(
+                Fixture.id, Fixture.matchday, Fixture.home_team,
+                Fixture.away_team
+            )
+        }
+        _fixture_ids_cache["checked_at"] = time.time()
+    fixture_index.set_ids(_fixture_ids_cache["ids"])
+    return fixture_index
 
 
+def populate_fixtures_table(fixture_index):
+    Fixture.sync(
+        db.session, [fixture.key for fixture in fixture_index.fixtures]
+    )
+    db.session.commit()
+    _fixture_ids_cache.clear()
+
+
+@db.read_only
+def get_user_count():
+    return User.query.count()
+
+
+@db.read_only
+def get_team_allocations():
+    # Teams are only allocated through add_user, which bumps "users"
+    version = get_version("users")
+    if _team_allocations_cache.get("version") == version:
+        return _team_allocations_cache["allocations"]
+
+    rows = db.session.query(Team.name, User.name).outerjoin(
+        User, User.allocated_team_id == Team.id
+    ).order_by(Team.name, User.id)
+    allocated_users = OrderedDict()
+    for team_name, user_name in rows:
+        users = allocated_users.setdefault(team_name, [])
+        if user_name is not None:
+            users.append(user_name)
+    allocations = OrderedDict(
+        (team_name, ", ".join(users))
+        for team_name, users in allocated_users.items()
+    )
+    _team_allocations_cache["allocations"] = allocations
+    _team_allocations_cache["version"] = version
+    return allocations
+
+
+@db.read_only
 def get_predictions_leaderboard():
-    all_users = User.query.order_by(desc(User.points)).all()
-    leaderboard = OrderedDict()
-    for user in all_users:
-        leaderboard[user.name] = {
-            "id": user.id,
-            "points": user.points
-        }
-    return leaderboard
+    version = get_leaderboard_version()
+    if _leaderboard_cache.get("version") != version:
+        rows = db.session.query(User.id, User.name, User.points).order_by(
+            desc(User.points), User.name
+        )
+        _leaderboard_cache["leaderboard"] = Leaderboard(rows)
+        _leaderboard_cache["version"] = version
+    return _leaderboard_cache["leaderboard"]
+
+
+def iter_leaderboard(chunk_size=1000):
+    rows = db.session.query(User.id, User.name, User.points).order_by(
+        desc(User.points), User.name
+    ).execution_options(stream_results=True).yield_per(chunk_size)
+    rank = 0
+    previous_points = None
+    # Rows are fetched as the generator is consumed, so the replica block
+    # has to be around the loop rather than the call
+    with db.replica():
+        for position, (user_id, name, points) in enumerate(rows, 1):
+            if points != previous_points:
+                rank = position
+                previous_points = points
+            yield rank, user_id, name, points
+
+
+def iter_predictions(chunk_size=1000):
+    rows = db.session.query(
+        User.id, User.name, Fixture.matchday, Fixture.home_team,
+        Prediction.home_score, Fixture.away_team, Prediction.away_score,
+        Prediction.points
+    ).join(Prediction.user).join(Prediction.fixture).order_by(
+        # The order of uq_predictions_user_fixture, so rows stream out of
+        # the index without sorting the whole table first
+        Prediction.user_id, Prediction.fixture_id
+    ).execution_options(stream_results=True).yield_per(chunk_size)
+    with db.replica():
+        for row in rows:
+            yield row
 
 
 def convert_submit_form_to_dict(form_predictions):
+    # Each editable row posts its fixture id and scores named after it
     predictions = []
-    i = 1
-    while True:
+    for fixture_id in form_predictions.getlist("fixture_id"):
         try:
             predictions.append({
-                "matchday": int(form_predictions["matchday_{0}".format(i)]),
-                "home_team": form_predictions["home_team_{0}".format(i)],
-                "home_score": form_predictions["home_score_{0}".format(i)],
-                "away_team": form_predictions["away_team_{0}".format(i)],
-                "away_score": form_predictions["away_score_{0}".format(i)]
+                "fixture_id": int(fixture_id),
+                "home_score": form_predictions["home_score_" + fixture_id],
+                "away_score": form_predictions["away_score_" + fixture_id]
             })
-            i += 1
-        except KeyError:
-            break
+        except (KeyError, ValueError):
+            raise Exception(
+                "Looks like your predictions were incomplete, please try "
+                "again!"
+            )
     return predictions
 
 
 def set_predictions(user, predictions):
+    existing_predictions = {
+        p.fixture_id: p
+        for p in db.session.query(
+            Prediction.id, Prediction.fixture_id, Prediction.home_score,
+            Prediction.away_score
+        ).filter_by(user_id=user.id)
+    }
+
+    inserts = []
+    updates = []
+    unchanged = 0
     for prediction in predictions:
-        try:
-            db_prediction = Prediction.query.filter_by(
-                user_id=user.id,
-                matchday=prediction["matchday"],
-                home_team=prediction["home_team"],
-                away_team=prediction["away_team"]
-            ).first()
-
-            if db_prediction is None:
-                db_prediction = Prediction(
-                    matchday=prediction["matchday"],
-                    home_team=prediction["home_team"],
-                    home_score=prediction["home_score"],
-                    away_team=prediction["away_team"],
-                    away_score=prediction["away_score"]
-                )
-                db.session.add(db_prediction)
-                user.predictions.append(db_prediction)
-            else:
-                db_prediction.home_score = prediction["home_score"]
-                db_prediction.away_score = prediction["away_score"]
-        except:
-            db.session.rollback()
-            raise
-    db.session.commit()
-    return True
+        home_score = int(prediction["home_score"])
+        away_score = int(prediction["away_score"])
+        existing = existing_predictions.get(prediction["fixture_id"])
+        if existing is None:
+            inserts.append({
+                "user_id": user.id,
+                "fixture_id": prediction["fixture_id"],
+                "home_score": home_score,
+                "away_score": away_score
+            })
+        elif (
+            existing.home_score != home_score or
+            existing.away_score != away_score
+        ):
+            updates.append({
+                "id": existing.id,
+                "home_score": home_score,
+                "away_score": away_score
+            })
+        else:
+            unchanged += 1
+
+    try:
+        if inserts:
+            db.session.bulk_insert_mappings(Prediction, inserts)
+        if updates:
+            db.session.bulk_update_mappings(Prediction, updates)
+        if inserts or updates:
+            User.query.filter_by(id=user.id).update(
+                {User.predictions_version: User.predictions_version + 1},
+                synchronize_session=False
+            )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return {
+        "inserted": len(inserts),
+        "updated": len(updates),
+        "unchanged": unchanged
+    }
 
 
 def populate_teams_table(teams):
@@ -154,55 +424,22 @@ def get_current_time():
 
 
 def get_points_for_user(user_predictions):
-    # Cater for fact that results table might not exist
-    try:
-        results = Result.query.all()
-    except:
-        return {}
-
-    user_points = {}
-
-    for result in results:
-        game = result.get_key()
-        if game in user_predictions:
-            score = result.get_value()
-            score_str = "{home_score} - {away_score}".format(**score)
-            if (
-                score["home_score"] == user_predictions[game]["home_score"] and
-                score["away_score"] == user_predictions[game]["away_score"]
-            ):
-                user_points[game] = {
-                    "result": score_str,
-                    "points": 3
-                }
-            elif (
-                score["home_score"] == score["away_score"] and
-                user_predictions[game]["home_score"] == user_predictions[game]["away_score"]  # noqa
-            ):
-                user_points[game] = {
-                    "result": score_str,
-                    "points": 1
-                }
-            elif (
-                score["home_score"] > score["away_score"] and
-                user_predictions[game]["home_score"] > user_predictions[game]["away_score"]  # noqa
-            ):
-                user_points[game] = {
-                    "result": score_str,
-                    "points": 1
-                }
-            elif (
-                score["home_score"] < score["away_score"] and
-                user_predictions[game]["home_score"] < user_predictions[game]["away_score"]  # noqa
-            ):
-                user_points[game] = {
-                    "result": score_str,
-                    "points": 1
-                }
-            else:
-                user_points[game] = {
-                    "result": score_str,
-                    "points": 0
-                }
-
-    return user_points
+    return get_points_for_results(user_predictions, get_results())
+
+
+def get_points_for_results(user_predictions, results):
+    games = [game for game in results if game in user_predictions]
+    points = score_predictions(
+        [user_predictions[game]["home_score"] for game in games],
+        [user_predictions[game]["away_score"] for game in games],
+        [results[game]["home_score"] for game in games],
+        [results[game]["away_score"] for game in games]
+    )
+
+    return {
+        game: {
+            "result": "{home_score} - {away_score}".format(**results[game]),
+            "points": int(game_points)
+        }
+        for game, game_points in zip(games, points)
+    }
@@ -198,11 +198,15 @@ class PredictionService(Blueprint):
                     "# Update config\n",
                     "sed -i.bak -e 's|_all_|", Ref("WhitelistedEmailDomains"), "|' -e 's|sqlite:///euro2016.db|mysql://", Ref("DBUser"), ":", Ref("DBPassword"), "@", Ref("DBAddress"), ":", Ref("DBPort"), "/", Ref("DBName"), "|' config/config.cfg\n",  # noqa
 
+                    "# Shared football-data state, owned by the workers\n",
+                    "mkdir -p /var/lib/euro2016\n",
+                    "chown nobody:nobody /var/lib/euro2016\n",
+
                     "# Create db tables\n",
                     "python create_db_tables.py\n",
 
                     "# Start application\n",
-                    "/usr/local/bin/gunicorn -c config/gunicorn.py app:app"
+                    "/usr/local/bin/gunicorn -c config/gunicorn.py wsgi:app"
                 ])),
                 ImageId=Ref("BaseAMI"),
                 KeyName=Ref("KeyName"),